@@ -1,26 +1,66 @@
 import sys, os, ast
 import pg_logger
-from collections import defaultdict
-from queue import Queue
+import trace_cache, trace_store
+from array import array
+
+# Interns locations as small ints. A location is either a variable, named by
+# its scope (a frame's unique_hash, 'global' or 'undefined') and name, or a
+# heap object, named by its ref.
+class LocationTable():
+    def __init__(self):
+        # Scope to name to location
+        self.var_locations = {}
+        # Ref to location
+        self.heap_locations = {}
+        # Location to ('heap', ref) or (scope, name), for debugging
+        self.keys = []
+
+    def _new_location(self, key):
+        self.keys.append(key)
+        return len(self.keys) - 1
+
+    def var(self, scope, name):
+        names = self.var_locations.get(scope)
+        if names is None:
+            names = self.var_locations[scope] = {}
+
+        loc = names.get(name)
+        if loc is None:
+            loc = names[name] = self._new_location((scope, name))
+        return loc
+
+    def heap(self, ref):
+        loc = self.heap_locations.get(ref)
+        if loc is None:
+            loc = self.heap_locations[ref] = self._new_location(('heap', ref))
+        return loc
+
+    def describe(self, loc):
+        scope, name = self.keys[loc]
+        return str(scope) + ':' + str(name)
 
 class VarEnvironment():
-    def __init__(self, execution_point):
+    def __init__(self, execution_point, locations):
+        self.locations = locations
         self.heap = execution_point['heap']
         self.globals = execution_point['globals']
         if len(execution_point['stack_to_render']) > 0:
             frame = execution_point['stack_to_render'][-1]
             self.locals = frame['encoded_locals']
             self.frame_hash = frame['unique_hash']
+            self.frame_id = frame['frame_id']
         else:
             self.locals = {}
+            self.frame_hash = None
+            self.frame_id = None
 
     def get_var(self, name):
         if name in self.locals:
-            return self.frame_hash + ':' + name
+            return self.locations.var(self.frame_hash, name)
         elif name in self.globals:
-            return 'global:' + name
+            return self.locations.var('global', name)
         else:
-            return 'undefined:' + name
+            return self.locations.var('undefined', name)
 
     def get_ref(self, name):
         if name in self.locals:
@@ -34,30 +74,35 @@ class VarEnvironment():
         else:
             return None
 
-    def vars(self):
-        my_vars = self.heap.copy()
-        
-        for name in self.globals:
-            my_vars['global:' + name] = self.globals[name]
-
-        for name in self.locals:
-            my_vars[self.frame_hash + ':' + name] = self.locals[name]
-
-        return my_vars
-        
     # Gets changes made in the second
     # Returns set of locations
     def diff(self, other):
-        my_vars = self.vars()
-        their_vars = other.vars()
-
-        # New variables
-        changes = their_vars.keys() - my_vars.keys()
-
-        # Old variables that changed
-        for loc in my_vars:
-            if loc in their_vars and my_vars[loc] != their_vars[loc]:
-                changes.add(loc)
+        locations = self.locations
+        changes = set()
+
+        # New or changed heap objects. Unchanged objects (and heaps) are
+        # shared between execution points, so those compare by identity.
+        if other.heap is not self.heap:
+            my_heap = self.heap
+            for ref, val in other.heap.items():
+                my_val = my_heap.get(ref)
+                if my_val is not val and my_val != val:
+                    changes.add(locations.heap(ref))
+
+        # New or changed globals
+        for name, val in other.globals.items():
+            if name not in self.globals or self.globals[name] != val:
+                changes.add(locations.var('global', name))
+
+        # New or changed locals, which are all new if they're from another
+        # frame
+        if other.frame_hash == self.frame_hash:
+            my_locals = self.locals
+        else:
+            my_locals = {}
+        for name, val in other.locals.items():
+            if name not in my_locals or my_locals[name] != val:
+                changes.add(locations.var(other.frame_hash, name))
 
         return changes
 
@@ -68,7 +113,10 @@ def find_attribute(var_env, val, identifier):
         return None, None
     
     attr_pairs = val[2:]
-    for ref1, ref2 in attr_pairs:
+    for pair in attr_pairs:
+        if pair[0] == 'TRUNCATED': # the attributes that didn't fit
+            continue
+        ref1, ref2 = pair
         assert(ref1[0] == 'REF')
         assert(ref2[0] == 'REF')
         key = var_env.heap[ref1[1]]
@@ -78,38 +126,90 @@ def find_attribute(var_env, val, identifier):
             value = var_env.heap[ref1[1]]
             return ref1[1], value
 
-# Attempts to find heap locations for the expression
+# Attempts to find heap locations for the attribute chain name.attr1.attr2...
 # Returns a set of heap refs, plus a value for the overall expression
-def find_refs(var_env, expr):
-    if isinstance(expr, ast.Name):
-        name_ref = var_env.get_ref(expr.id)
-        return set([name_ref]), var_env.heap[name_ref]
-    elif isinstance(expr, ast.Attribute):
-        instance_refs, instance = find_refs(var_env, expr.value)
+def find_refs(var_env, name, attrs):
+    name_ref = var_env.get_ref(name)
+    instance_refs = set([name_ref])
+    instance = var_env.heap[name_ref]
 
+    for attr in attrs:
         if not instance:
             return instance_refs, None
-        
-        attr_ref, attr_value = find_attribute(var_env, instance, expr.attr)
+
+        attr_ref, attr_value = find_attribute(var_env, instance, attr)
         if attr_ref:
             instance_refs.add(attr_ref)
-            return instance_refs, attr_value
+            instance = attr_value
         else:
             return instance_refs, None
-    else:
-        raise 'Unsupported find_refs argument'
-    
+
+    return instance_refs, instance
+
 ignored_events = set(['raw_input'])
-def trace(source, ri):
-    def finalizer(input_code, output_trace):
-        filtered_trace = [ep for ep in output_trace if ep['event'] not in ignored_events]
-        return filtered_trace
-    
-    return pg_logger.exec_script_str_local(source,
-                                           ri,
-                                           True,
-                                           True,
-                                           finalizer)
+
+# Traces only what slicing looks at (see PGLogger's dataflow_only), so
+# execution points lack stdout, zombie frames and the ordered_* lists.
+#
+# If record_accesses, execution points also list the variable reads and
+# writes made since the previous one (see AccessRelationBuilder).
+#
+# If cache is a trace_cache.TraceCache, reuse a previous trace of the same
+# source and raw_input
+def trace(source, ri, cache=None, record_accesses=False):
+    # everything passed to the tracer besides the script, so that the cache
+    # key below can't leave any of it out
+    tracer_kwargs = dict(dataflow_only=True,
+                         ignored_events=ignored_events,
+                         monitoring=True,
+                         record_accesses=record_accesses)
+
+    def run():
+        return pg_logger.exec_script_str_local(source,
+                                               ri,
+                                               True,
+                                               True,
+                                               lambda input_code, output_trace: output_trace,
+                                               **tracer_kwargs)
+
+    if cache is None:
+        return run()
+
+    options = dict(tracer_kwargs,
+                   cumulative_mode=True,
+                   heap_primitives=True,
+                   ignored_events=sorted(ignored_events),
+                   max_executed_lines=pg_logger.MAX_EXECUTED_LINES)
+    return cache.get_or_trace(trace_cache.cache_key(source, ri, options), run)
+
+# Like trace, but yields execution points as they are produced
+def trace_iter(source, ri):
+    return pg_logger.exec_script_str_iter(source, ri, True, True,
+                                          dataflow_only=True,
+                                          ignored_events=ignored_events,
+                                          monitoring=True)
+
+# Like trace, but calls callback on each execution point from inside the
+# tracer instead of returning them
+def trace_online(source, ri, callback, max_executed_lines=None,
+                 record_accesses=False):
+    pg_logger.exec_script_str_local(source,
+                                    ri,
+                                    True,
+                                    True,
+                                    lambda input_code, output_trace: None,
+                                    step_callback=callback,
+                                    max_executed_lines=max_executed_lines,
+                                    dataflow_only=True,
+                                    ignored_events=ignored_events,
+                                    monitoring=True,
+                                    record_accesses=record_accesses)
+
+# Traces source straight into a trace_store file at path, without keeping
+# the trace in memory
+def trace_to_file(source, ri, path, compression=None, max_executed_lines=None):
+    with trace_store.TraceWriter(path, compression) as writer:
+        trace_online(source, ri, writer.append, max_executed_lines)
 
 class LineMapVisitor(ast.NodeVisitor):
     def __init__(self):
@@ -125,22 +225,48 @@ Currently only handles the case where statements are on separate lines.
 
 TODO: Transform the original source so that statements are always on separate
 lines.
+
+with statements are only supported if record_accesses (see ControlVisitor).
 """
-def make_line_maps(source):
+def make_line_maps(source, record_accesses=False):
     astree = ast.parse(source)
     map_visitor = LineMapVisitor()
     map_visitor.visit(astree)
 
-    control_visitor = ControlVisitor()
+    control_visitor = ControlVisitor(allow_with=record_accesses)
     control_visitor.visit(astree)
     
     return map_visitor.the_map, control_visitor.line_to_controller
 
-class UseVisitor(ast.NodeVisitor):
-    def __init__(self, exec_point):
-        self.exec_point = exec_point
-        self.env = VarEnvironment(exec_point)
-        self.use_set = set()
+# What a statement reads, worked out once from its AST: the names whose
+# variables and objects it uses, and the attribute chains (name, (attr, ...))
+# whose objects it uses. Only the lookups in each step's environment are
+# left for execution time.
+class UseTemplate():
+    def __init__(self, names, attribute_chains):
+        self.names = names
+        self.attribute_chains = attribute_chains
+
+    def uses(self, env):
+        use_set = set()
+
+        for name in self.names:
+            use_set.add(env.get_var(name))
+            ref = env.get_ref(name)
+            if ref is not None:
+                use_set.add(env.locations.heap(ref))
+
+        for name, attrs in self.attribute_chains:
+            refs, _ = find_refs(env, name, attrs)
+            for ref in refs:
+                use_set.add(env.locations.heap(ref))
+
+        return use_set
+
+class UseTemplateVisitor(ast.NodeVisitor):
+    def __init__(self):
+        self.names = []
+        self.attribute_chains = []
 
     def die(self, node):
         raise ValueError('Unsupported node: ' + str(type(node)))
@@ -148,6 +274,13 @@ class UseVisitor(ast.NodeVisitor):
     def nothing(self, node):
         pass
 
+    def template(self):
+        # Dedupe, but keep the order things were found in
+        names = tuple(sorted(set(self.names), key=self.names.index))
+        chains = tuple(sorted(set(self.attribute_chains),
+                              key=self.attribute_chains.index))
+        return UseTemplate(names, chains)
+
     # Exprs
     # BoolOp
     # BinOp
@@ -175,16 +308,22 @@ class UseVisitor(ast.NodeVisitor):
     # Constant
     
     def visit_Attribute(self, node):
-        refs, _ = find_refs(self.env, node)
-        self.use_set |= refs
+        attrs = []
+        while isinstance(node, ast.Attribute):
+            attrs.append(node.attr)
+            node = node.value
+        if not isinstance(node, ast.Name):
+            self.die(node)
+
+        attrs.reverse()
+        self.attribute_chains.append((node.id, tuple(attrs)))
     
     visit_Subscript = die
     
     visit_Starred = die
 
     def visit_Name(self, node):
-        self.use_set.add(self.env.get_var(node.id))
-        self.use_set.add(self.env.get_ref(node.id))
+        self.names.append(node.id)
 
     # List
     # Tuple
@@ -201,7 +340,9 @@ class UseVisitor(ast.NodeVisitor):
     visit_Delete = die
 
     def visit_Assign(self, stmt):
-        self.visit(stmt.value)
+        # AnnAssign may have no value
+        if stmt.value:
+            self.visit(stmt.value)
 
     def visit_AugAssign(self, stmt):
         self.visit(stmt.target)
@@ -235,15 +376,26 @@ class UseVisitor(ast.NodeVisitor):
     # Break
     # Continue
 
+# Builds a use template for every statement in line_map, raising ValueError
+# for unsupported constructs before anything gets traced
+def make_use_templates(line_map):
+    templates = {}
+    for line, stmt in line_map.items():
+        visitor = UseTemplateVisitor()
+        visitor.visit(stmt)
+        templates[line] = visitor.template()
+    return templates
+
 # Creates a map from statement lines to the lines of the immediately-enclosing
 # controller.
 #
 # TODO: Support unstructured control flow (break, continue, early return, etc.)
 class ControlVisitor(ast.NodeVisitor):
-    def __init__(self):
+    def __init__(self, allow_with=False):
         # Maps statements to their immediate controllers
         self.line_to_controller = {}
         self.enclosing_controller = 0
+        self.allow_with = allow_with
 
     def die(self, node):
         raise ValueError('Unsupported node: ' + str(type(node)))
@@ -293,7 +445,14 @@ class ControlVisitor(ast.NodeVisitor):
     visit_While = visit_IfLike
     visit_If = visit_IfLike
     
-    visit_With = die
+    # The body of a with always runs, so it has the same controller as the
+    # with. RelationBuilder can't tell what a with uses (see
+    # UseTemplateVisitor), so it's only supported when recording accesses.
+    def visit_With(self, node):
+        if not self.allow_with:
+            self.die(node)
+        self.generic_visit(node)
+
     visit_AsyncWith = die
 
     visit_Raise = die
@@ -302,57 +461,463 @@ class ControlVisitor(ast.NodeVisitor):
     visit_Break = die
     visit_Continue = die
     
-def used_stmt(exec_point, stmt):
-    visitor = UseVisitor(exec_point)
-    visitor.visit(stmt)
-    return visitor.use_set
+def used_stmt(env, template):
+    return template.uses(env)
 
-def defined_stmt(exec_point, next_exec_point):
-    now_vars = VarEnvironment(exec_point)
-    next_vars = VarEnvironment(next_exec_point)
+def defined_stmt(env, next_env):
+    return env.diff(next_env)
 
-    return now_vars.diff(next_vars)
+"""
+The combined UD and CT relation in compressed sparse row form: the steps
+that step s depends on are targets[offsets[s]:offsets[s + 1]], and
+step_lines[s] is the line that step s executed, or 0 if it wasn't a
+statement step (calls, returns, ...). Steps are added in order, so the graph
+can be built while tracing.
+"""
+class DependenceGraph():
+    def __init__(self):
+        self.offsets = array('l', [0])
+        self.targets = array('l')
+        self.step_lines = array('l')
 
-# Returns a map from steps to lines and a combined UD and CT "multimap"
-def build_relations(line_map, line_to_control, tr):
-    # UD instead of DU, so we can go use -> definition. Similarly, use CT
-    # instead of TC
-    UD_CT = defaultdict(set)
-    step_to_line = {}
-    line_to_step = defaultdict(set)
+    def __len__(self):
+        return len(self.step_lines)
+
+    def add_step(self, line, infl_steps):
+        self.targets.extend(infl_steps)
+        self.offsets.append(len(self.targets))
+        self.step_lines.append(line)
+
+    # Adds more dependences to the most recently added step
+    def extend_last_step(self, infl_steps):
+        self.targets.extend(infl_steps)
+        self.offsets[-1] = len(self.targets)
+
+    def influencing_steps(self, step):
+        return self.targets[self.offsets[step]:self.offsets[step + 1]]
+
+    def statement_steps(self):
+        return [step for step, line in enumerate(self.step_lines) if line]
+
+    def steps_at_line(self, line):
+        return [step for step, l in enumerate(self.step_lines) if l == line]
+
+    # Returns the set of steps that the given steps transitively depend on,
+    # themselves included
+    def reachable(self, steps):
+        offsets = self.offsets
+        targets = self.targets
+        visited = bytearray(len(self))
+        stack = list(steps)
+        result = set()
+
+        while stack:
+            step = stack.pop()
+            if visited[step]:
+                continue
+            visited[step] = 1
+            result.add(step)
+
+            # Put influencing steps on the stack
+            stack.extend(targets[offsets[step]:offsets[step + 1]])
+
+        return result
+
+# Number of set bits in an int
+def popcount(bits):
+    return bin(bits).count('1')
 
-    # Reference to step
-    last_definitions = {}
+"""
+A set of steps of one dependence graph, stored as a bitset in a Python int
+(bit s is set if step s is in the slice), so union, intersection and
+difference of slices are single big-int operations.
+"""
+class Slice():
+    def __init__(self, graph, bits=0):
+        self.graph = graph
+        self.bits = bits
+
+    def __or__(self, other):
+        if not isinstance(other, Slice):
+            return NotImplemented
+        return Slice(self.graph, self.bits | other.bits)
+
+    def __and__(self, other):
+        if not isinstance(other, Slice):
+            return NotImplemented
+        return Slice(self.graph, self.bits & other.bits)
+
+    def __sub__(self, other):
+        if not isinstance(other, Slice):
+            return NotImplemented
+        return Slice(self.graph, self.bits & ~other.bits)
+
+    def __eq__(self, other):
+        if not isinstance(other, Slice):
+            return NotImplemented
+        return self.graph is other.graph and self.bits == other.bits
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __len__(self):
+        return popcount(self.bits)
+
+    def __contains__(self, step):
+        return (self.bits >> step) & 1 == 1
+
+    def steps(self):
+        bits = self.bits
+        while bits:
+            low = bits & -bits
+            yield low.bit_length() - 1
+            bits ^= low
+
+    def lines(self):
+        return set([self.graph.step_lines[step] for step in self.steps()])
+
+"""
+Answers slice queries on a dependence graph by transitive closure over
+bitsets: the closure of a step is its own bit OR the closures of the steps
+it depends on. Dependences only point backward in time, so closures are
+computed in step order, once each, up to the latest step asked about.
+That makes many queries on the same trace cheap, at the cost of keeping one
+bitset per step.
+"""
+class SliceEngine():
+    def __init__(self, graph):
+        self.graph = graph
+        # Closure bitset of every step before len(self.closures)
+        self.closures = []
+
+    def _extend_to(self, step):
+        closures = self.closures
+        offsets = self.graph.offsets
+        targets = self.graph.targets
+
+        for s in range(len(closures), step + 1):
+            bits = 1 << s
+            for t in targets[offsets[s]:offsets[s + 1]]:
+                bits |= closures[t]
+            closures.append(bits)
+
+    def step_slice(self, step):
+        if step >= len(self.closures):
+            self._extend_to(step)
+        return Slice(self.graph, self.closures[step])
+
+    # The union of the slices of every execution of line
+    def line_slice(self, line):
+        steps = self.graph.steps_at_line(line)
+        if steps:
+            self._extend_to(steps[-1])
+
+        bits = 0
+        for step in steps:
+            bits |= self.closures[step]
+        return Slice(self.graph, bits)
+
+# Incrementally builds the dependence graph, one execution point at a time.
+# Each point is only kept around until the next one arrives, so this works
+# both over a stored trace and online, as a PGLogger step_callback (see
+# trace_online).
+#
+# Raises ValueError right away if line_map has unsupported statements.
+class RelationBuilder():
+    def __init__(self, line_map, line_to_control):
+        self.line_map = line_map
+        self.line_to_control = line_to_control
+        self.use_templates = make_use_templates(line_map)
+
+        # UD instead of DU, so we can go use -> definition. Similarly, use CT
+        # instead of TC
+        self.graph = DependenceGraph()
+
+        # Line to the most recent step that executed it
+        self.last_step_at_line = {}
+
+        self.locations = LocationTable()
+
+        # Location to step
+        self.last_definitions = {}
+
+        # (step, environment) of the last step_line, whose definitions are
+        # found by diffing it against the execution point right after it
+        self.pending_def = None
+
+        # First step with an exception, if any
+        self.exception_step = None
+
+        self.step = 0
+
+    def add(self, exec_point):
+        step = self.step
+        self.step += 1
+
+        # One environment per step, shared by the def and use processing
+        # e.g. 'instruction_limit_reached' has no state to look at
+        if 'heap' in exec_point:
+            env = VarEnvironment(exec_point, self.locations)
+        else:
+            env = None
+
+        if self.pending_def:
+            def_step, def_env = self.pending_def
+            if env:
+                stmt_defineds = defined_stmt(def_env, env)
+                for loc in stmt_defineds:
+                    self.last_definitions[loc] = def_step
+            self.pending_def = None
 
-    for step, exec_point in enumerate(tr):
         if exec_point['event'] not in ['step_line', 'exception', 'uncaught_exception']:
-            continue
+            self.graph.add_step(0, ())
+            return
 
-        line = exec_point['line']
-        line_to_step[line].add(step)
-        stmt = line_map[line]
+        if exec_point['event'] != 'step_line' and self.exception_step is None:
+            self.exception_step = step
 
-        step_to_line[step] = line
+        line = exec_point['line']
+        infl_steps = set()
 
         # Use-Definition processing
-        stmt_useds = used_stmt(exec_point,  stmt)
-        for ref in stmt_useds:
-            if ref in last_definitions:
-                UD_CT[step].add(last_definitions[ref])
+        stmt_useds = used_stmt(env, self.use_templates[line])
+        for loc in stmt_useds:
+            if loc in self.last_definitions:
+                infl_steps.add(self.last_definitions[loc])
 
         if exec_point['event'] == 'step_line':
-            stmt_defineds = defined_stmt(tr[step], tr[step + 1])
-            for ref in stmt_defineds:
-                last_definitions[ref] = step
+            self.pending_def = (step, env)
 
         # Test-Control processing
         # TODO: Support control dependencies caused by function calls
-        control = line_to_control[line]
-        if line_to_step[control]:
-            control_step = max(line_to_step[control])
-            UD_CT[step].add(control_step)
+        control = self.line_to_control[line]
+        if control in self.last_step_at_line:
+            infl_steps.add(self.last_step_at_line[control])
+
+        self.last_step_at_line[line] = step
+        self.graph.add_step(line, sorted(infl_steps))
+
+# Appends the refs that an encoded value points to onto refs
+def collect_refs(val, refs):
+    if isinstance(val, list):
+        if len(val) == 2 and val[0] == 'REF':
+            refs.append(val[1])
+        else:
+            for e in val:
+                collect_refs(e, refs)
+
+# Returns the set of refs reachable from refs in at most depth steps,
+# following objects through whichever of heaps has them
+def reachable_refs(refs, depth, heaps):
+    reached = set(refs)
+    frontier = list(reached)
+    for _ in range(depth):
+        children = []
+        for ref in frontier:
+            for heap in heaps:
+                if ref in heap:
+                    collect_refs(heap[ref], children)
+                    break
+        frontier = [ref for ref in children if ref not in reached]
+        if not frontier:
+            break
+        reached.update(frontier)
+    return reached
 
-    return step_to_line, line_to_step, UD_CT
+"""
+Like RelationBuilder, but for traces made with record_accesses, which say
+exactly which variables each step read and wrote. Variable dependences come
+straight from those instead of from use templates and environment diffs, so
+any statement is supported.
+
+Attribute and item accesses are only counted, since the objects involved
+aren't visible to the tracer. For those, a statement uses (and, if they
+changed, defines) the objects within that many references of the values it
+has read so far, counting everything since its execution point.
+
+A step's accesses arrive with the next execution point. Whatever happens
+after a 'return' belongs to the caller resuming its statement, so that
+return step becomes a statement step at the caller's line, depending on the
+caller's earlier step and on the callee's last one.
+
+Back-to-back steps at the same line of the same frame (one-line loops and
+comprehensions) build up values on the stack across those steps, so each
+depends on the one before.
+"""
+class AccessRelationBuilder(RelationBuilder):
+    def __init__(self, line_map, line_to_control):
+        self.line_map = line_map
+        self.line_to_control = line_to_control
+
+        self.graph = DependenceGraph()
+        self.last_step_at_line = {}
+        self.locations = LocationTable()
+        self.last_definitions = {}
+        self.exception_step = None
+        self.step = 0
+
+        # Frame id (None for the global scope) to the statement it's running
+        self.statements = {}
+
+        # Frame ids of the callers of the running calls
+        self.callers = []
+
+        # Frame id whose statement the accesses after the last execution
+        # point belong to
+        self.running_frame = None
+
+        # (step, environment, steps it already depends on, the step that
+        # produced the return value if it's a 'return') of the last
+        # execution point, whose accesses come with the next one
+        self.pending_step = None
+
+    def control_step(self, line):
+        control = self.line_to_control[line]
+        return self.last_step_at_line.get(control)
+
+    def add(self, exec_point):
+        step = self.step
+        self.step += 1
+
+        if 'heap' in exec_point:
+            env = VarEnvironment(exec_point, self.locations)
+        else:
+            env = None
+
+        event = exec_point['event']
+        if self.pending_step:
+            self.add_accesses(exec_point.get('accesses', ()), env, event)
+
+        frame_id = env.frame_id if env else None
+        statement = self.statements.get(frame_id)
+        infl_steps = set()
+        line = 0
+        return_step = None
+
+        if event in ['step_line', 'exception', 'uncaught_exception']:
+            if event != 'step_line' and self.exception_step is None:
+                self.exception_step = step
+
+            line = exec_point['line']
+            control_step = self.control_step(line)
+            if control_step is not None:
+                infl_steps.add(control_step)
+
+            if event == 'step_line':
+                if statement and statement.line == line:
+                    infl_steps.add(statement.step)
+                self.statements[frame_id] = RunningStatement(step, line)
+                self.last_step_at_line[line] = step
+            elif statement:
+                # the statement that raised it
+                infl_steps.add(statement.step)
+            self.running_frame = frame_id
+        elif event == 'call' and env:
+            # Arguments are bound by the caller's statement
+            caller = self.statements.get(self.running_frame)
+            if caller:
+                for name in env.locals:
+                    self.last_definitions[self.locations.var(frame_id, name)] = caller.step
+            self.callers.append(self.running_frame)
+            self.running_frame = frame_id
+        elif event == 'return':
+            if statement:
+                return_step = statement.step
+            self.running_frame = self.callers.pop() if self.callers else None
+
+        self.graph.add_step(line, sorted(infl_steps))
+        self.pending_step = (step, env, infl_steps, return_step)
+
+    def add_accesses(self, accesses, next_env, next_event):
+        step, env, infl_steps, return_step = self.pending_step
+        self.pending_step = None
+
+        statement = self.statements.get(self.running_frame)
+        if not statement:
+            return
+
+        locations = self.locations
+        last_definitions = self.last_definitions
+        new_infl_steps = set()
+
+        for access in accesses:
+            if access[0] == 'use':
+                if access[4] is not None:
+                    statement.refs.add(access[4])
+            elif access[0] == 'deref':
+                statement.depth += 1
+
+        before = env.heap if env else {}
+        after = next_env.heap if next_env else before
+        reached = reachable_refs(statement.refs, statement.depth, (before, after))
+        changed = [ref for ref in reached if before.get(ref) != after.get(ref)]
+
+        # A caller picking up where it left off after a call (which counts
+        # even if it does nothing else but make another call, since that
+        # can pass on the return value, as in f(g(x)))
+        if self.graph.step_lines[step] == 0:
+            if not accesses and not changed and next_event != 'call':
+                return
+
+            new_infl_steps.add(statement.step)
+            if return_step is not None:
+                new_infl_steps.add(return_step)
+            control_step = self.control_step(statement.line)
+            if control_step is not None:
+                new_infl_steps.add(control_step)
+
+            self.graph.step_lines[step] = statement.line
+            self.last_step_at_line[statement.line] = step
+            statement.step = step
+
+        for access in accesses:
+            if access[0] == 'use':
+                loc = locations.var(access[2], access[3])
+                if loc in last_definitions:
+                    new_infl_steps.add(last_definitions[loc])
+            elif access[0] == 'def':
+                last_definitions[locations.var(access[2], access[3])] = step
+
+        for ref in reached:
+            loc = locations.heap(ref)
+            if loc in last_definitions:
+                new_infl_steps.add(last_definitions[loc])
+        for ref in changed:
+            last_definitions[locations.heap(ref)] = step
+
+        new_infl_steps.discard(step)
+        self.graph.extend_last_step(sorted(new_infl_steps - infl_steps))
+
+# What AccessRelationBuilder knows about the statement a frame is running:
+# its latest step and line, plus the refs it has read and how many attribute
+# or item accesses it has made so far
+class RunningStatement():
+    def __init__(self, step, line):
+        self.step = step
+        self.line = line
+        self.refs = set()
+        self.depth = 0
+
+def relation_builder(line_map, line_to_control, record_accesses=False):
+    if record_accesses:
+        return AccessRelationBuilder(line_map, line_to_control)
+    return RelationBuilder(line_map, line_to_control)
+
+# Returns the dependence graph of a trace
+#
+# tr can be any iterable of execution points, e.g. trace_iter(...)
+def build_relations(line_map, line_to_control, tr):
+    builder = RelationBuilder(line_map, line_to_control)
+    for exec_point in tr:
+        builder.add(exec_point)
+
+    return builder.graph
 
 def find_exception(trace):
     for step, exec_point in enumerate(trace):
@@ -365,34 +930,94 @@ Returns a set of line numbers.
 TODO: Guess or allow specification of specific values to track.
 """
 
-def slice(source, ri, line=None, debug=False):
-    line_map, line_to_control = make_line_maps(source)
-    tr = trace(source, ri)
+def slice(source, ri, line=None, debug=False, cache=None, record_accesses=False):
+    line_map, line_to_control = make_line_maps(source, record_accesses)
+    # Made before tracing, so unsupported code fails fast
+    builder = relation_builder(line_map, line_to_control, record_accesses)
+    tr = trace(source, ri, cache, record_accesses)
     
-    step_to_line, line_to_step, UD_CT = build_relations(line_map, line_to_control, tr)
-
-    visited = set()
-    queue = Queue()
+    for exec_point in tr:
+        builder.add(exec_point)
     exception_step = find_exception(tr)
 
+    return slice_relations(line_map, builder.graph, exception_step, line)
+
+"""
+Like slice, but builds the dependences while the program runs instead of
+keeping the whole trace around, so memory grows with the number of live
+locations rather than with the number of steps. That makes it feasible to
+raise max_executed_lines well beyond pg_logger.MAX_EXECUTED_LINES.
+"""
+def slice_online(source, ri, line=None, debug=False, max_executed_lines=None,
+                 record_accesses=False):
+    line_map, line_to_control = make_line_maps(source, record_accesses)
+    builder = relation_builder(line_map, line_to_control, record_accesses)
+    trace_online(source, ri, builder.add, max_executed_lines, record_accesses)
+
+    return slice_relations(line_map, builder.graph, builder.exception_step,
+                           line)
+
+"""
+Like slice, but reads the trace of source from a file written by
+trace_to_file, one execution point at a time.
+"""
+def slice_stored(source, path, line=None, debug=False):
+    line_map, line_to_control = make_line_maps(source)
+    builder = RelationBuilder(line_map, line_to_control)
+    with trace_store.TraceReader(path) as tr:
+        for exec_point in tr:
+            builder.add(exec_point)
+
+    return slice_relations(line_map, builder.graph, builder.exception_step,
+                           line)
+
+def slice_relations(line_map, graph, exception_step, line=None):
     if exception_step:
-        print('Exception at line ' + str(step_to_line[exception_step]))
+        print('Exception at line ' + str(graph.step_lines[exception_step]))
     elif not line:
         return None, 0
 
-    for step in [exception_step] if exception_step else line_to_step[line]:
-        queue.put(step)
-    while not queue.empty():
-        step = queue.get()
-        if step in visited:
-            continue
-        visited.add(step)
-
-        # Put influencing steps in the queue
-        for infl_step in UD_CT[step]:
-            queue.put(infl_step)
+    start_steps = [exception_step] if exception_step else graph.steps_at_line(line)
+    visited = graph.reachable(start_steps)
 
-    keep_these = set([step_to_line[step] for step in visited])
+    keep_these = set([graph.step_lines[step] for step in visited])
     stmt_count = float(len(line_map))
             
     return keep_these, len(set(line_map) - keep_these) / stmt_count
+
+# Returns a map from each executed line to the set of lines in its slice,
+# the same as what slice would keep for that line
+#
+# The slice of each line comes from a SliceEngine, which works out every
+# step's closure once. Its lines are found with one bitset per line (of the
+# steps that executed it) rather than step by step. Equal slices are
+# shared rather than copied.
+def slice_all_lines(graph):
+    engine = SliceEngine(graph)
+
+    line_masks = {}
+    for step, line in enumerate(graph.step_lines):
+        if line:
+            line_masks[line] = line_masks.get(line, 0) | (1 << step)
+
+    line_slices = {}
+    canonical = {}
+    for line in line_masks:
+        bits = engine.line_slice(line).bits
+        lines = frozenset([l for l, mask in line_masks.items() if bits & mask])
+        line_slices[line] = canonical.setdefault(lines, lines)
+
+    return line_slices
+
+"""
+Returns a map from each executed line to the set of line numbers in its
+slice, computed in one pass over the trace rather than one slice call per
+line.
+"""
+def slice_all(source, ri, cache=None, record_accesses=False):
+    line_map, line_to_control = make_line_maps(source, record_accesses)
+    builder = relation_builder(line_map, line_to_control, record_accesses)
+    for exec_point in trace(source, ri, cache, record_accesses):
+        builder.add(exec_point)
+
+    return slice_all_lines(builder.graph)
@@ -62,15 +62,38 @@
 #   * compound object reference - ['REF', target object's unique_id]
 #
 # the unique_id is derived from id(), which allows us to capture aliasing
+#
+#   If the encoder has budgets (see ObjectEncoder), a list, tuple, set,
+#   dict, instance or class whose contents got cut off ends with
+#     ['TRUNCATED', number of elements/pairs/attributes left out, reason]
+#   where reason is 'elements' (it has more than max_elements), 'depth'
+#   (it's max_depth deep) or 'objects' (the heap already had max_objects).
 
 
 # number of significant digits for floats
 FLOAT_PRECISION = 4
 
+# most attribute orders of one type whose sorted attributes ObjectEncoder
+# remembers
+SORTED_USER_ATTRS_PER_TYPE = 64
+
+# most heap objects under a tuple whose encoding ObjectEncoder caches
+# (each cache entry lists all of them, so deeply nested tuples would
+# otherwise take quadratic memory)
+MAX_CACHED_DESCENDANTS = 1000
+
+# keys of dicts (locals, mostly) that don't get displayed
+HIDDEN_DICT_KEYS = frozenset(['__module__', '__return__', '__locals__'])
+
 
 from collections import defaultdict
 import re, types
 import sys
+import itertools
+from operator import itemgetter
+import weakref
+# (bound now, since exec_script_str's sandbox empties the gc module)
+from gc import get_referents, is_tracked
 import math
 typeRE = re.compile("<type '(.*)'>")
 classRE = re.compile("<class '(.*)'>")
@@ -110,6 +133,9 @@ def get_name(obj):
 
 
 PRIMITIVE_TYPES = (int, long, float, str, unicode, bool, type(None))
+PRIMITIVE_TYPE_SET = frozenset(PRIMITIVE_TYPES)
+# the ones that encode_primitive returns as they are
+VERBATIM_TYPE_SET = PRIMITIVE_TYPE_SET - set([float] if is_python3 else [float, str])
 
 def encode_primitive(dat):
   t = type(dat)
@@ -157,19 +183,341 @@ def create_lambda_line_number(codeobj, line_to_lambda_code):
     return ''
 
 
+# Gives each object a small ID for as long as it's alive.
+#
+# id() values get reused once an object dies, so an id() alone can't
+# tell a new object apart from a dead one. An object's entry therefore
+# only lasts while the object does:
+# - objects that support weakrefs get one, whose callback forgets the
+#   entry as soon as the object dies
+# - the rest (lists, dicts, tuples, ints, ...) get pinned, which keeps
+#   them alive and their id()s unused. every so often, pinned objects that
+#   nothing else refers to anymore get unpinned and forgotten.
+# A forgotten object's small ID is never handed out again.
+#
+# (Pinned objects in garbage reference cycles never look unreferenced, so
+# sweeps also look for cycles that only the registry keeps alive -- see
+# unpin_garbage_cycles.)
+class SmallIDRegistry:
+  def __init__(self):
+    # Key: id() of a live object
+    # Value: its small ID
+    self.small_ids = {}
+    self.next_small_id = 1
+
+    # Key: id() of an object
+    # Value: weakref to it, or the object itself if it's pinned
+    self.weakrefs = {}
+    self.pinned = {}
+
+    # sweep the pinned objects once there are this many of them
+    self.sweep_size = 1024
+
+    # add's sweeps look for garbage cycles once next_small_id gets this
+    # far (see sweep)
+    self.next_cycle_search = 0
+
+    # what sys.getrefcount() says about a pinned object, during a sweep,
+    # when nothing else refers to it
+    self.pinned_only_refcount = self.measure_pinned_only_refcount()
+
+  def measure_pinned_only_refcount(self):
+    self.pinned[None] = []
+    refcount = sys.getrefcount(self.pinned[None])
+    del self.pinned[None]
+    return refcount
+
+  def forget(self, ref):
+    del self.small_ids[ref.key]
+    del self.weakrefs[ref.key]
+
+  # returns obj's small ID, giving it a new one if it doesn't have one
+  def add(self, obj):
+    my_id = id(obj)
+    try:
+      return self.small_ids[my_id]
+    except KeyError:
+      pass
+
+    small_id = self.next_small_id
+    self.next_small_id += 1
+    self.small_ids[my_id] = small_id
+
+    try:
+      self.weakrefs[my_id] = weakref.KeyedRef(obj, self.forget, my_id)
+    except TypeError:
+      self.pinned[my_id] = obj
+      if len(self.pinned) >= self.sweep_size:
+        self.sweep(self.next_small_id >= self.next_cycle_search)
+    return small_id
+
+  # returns obj's small ID, or None if it doesn't have one
+  def get(self, obj):
+    return self.small_ids.get(id(obj))
+
+  # unpins and forgets the pinned objects that only we refer to, and if
+  # find_cycles, the ones in garbage cycles too
+  def sweep(self, find_cycles=True):
+    # (in the order they were pinned, which tends to put containers
+    # before what's in them, so unpinning a container can make what was
+    # in it unreferenced in time for this same sweep)
+    pinned = self.pinned
+    for key in list(pinned):
+      if sys.getrefcount(pinned[key]) <= self.pinned_only_refcount:
+        del pinned[key]
+        del self.small_ids[key]
+
+    # (that looks at everything reachable from pinned objects, which can
+    # be far more than what's pinned, so add only asks for it again once
+    # at least that many new small IDs have been handed out)
+    if find_cycles:
+      self.next_cycle_search = self.next_small_id + self.unpin_garbage_cycles()
+
+    # so that sweeping takes constant time per pinned object on average
+    self.sweep_size = max(1024, 2 * len(pinned))
+
+  # Unpins and forgets the pinned objects that are only alive because
+  # we keep some reference cycle alive (a list that contains itself, a
+  # list in an attribute of an object that it contains, ...), so that
+  # the garbage collector can then collect those cycles like it would
+  # have without us.
+  #
+  # Works like the garbage collector does, on the objects reachable from
+  # pinned ones: those that something outside of them refers to are
+  # alive, and so is everything they refer to. Pinned objects that
+  # aren't alive that way are garbage.
+  #
+  # Returns how many objects it looked at.
+  def unpin_garbage_cycles(self):
+    objs, referents = self.reachable_from_pinned()
+    if not objs:
+      return 0
+    pinned = self.pinned
+
+    # how many references to each object come from outside objs (not
+    # counting objs itself and pinned)
+    outside_refs = {}
+    for key in objs:
+      outside_refs[key] = sys.getrefcount(objs[key]) - self.pinned_only_refcount
+      if key in pinned:
+        outside_refs[key] -= 1
+    for keys in referents.values():
+      for key in keys:
+        outside_refs[key] -= 1
+
+    alive = [key for key in objs if outside_refs[key] > 0]
+    alive_set = set(alive)
+    while alive:
+      for key in referents[alive.pop()]:
+        if key not in alive_set:
+          alive_set.add(key)
+          alive.append(key)
+
+    for key in objs:
+      if key in pinned and key not in alive_set:
+        del pinned[key]
+        del self.small_ids[key]
+    return len(objs)
+
+  # Returns the objects that could be in a reference cycle with pinned
+  # objects, by id(), and the id()s of those of them that each one refers
+  # to. That doesn't go into classes, modules, functions, code or frames,
+  # which refer to much more than just program data (so if one of those
+  # refers to a pinned object, it counts as alive).
+  #
+  # (Only id()s go in the second dict, so that it doesn't add references
+  # to the objects and throw off their refcounts.)
+  def reachable_from_pinned(self):
+    objs = {}
+    referents = {}
+    stack = [obj for obj in self.pinned.values() if is_tracked(obj)]
+    while stack:
+      obj = stack.pop()
+      if id(obj) in objs:
+        continue
+      objs[id(obj)] = obj
+      keys = referents[id(obj)] = []
+      for ref in get_referents(obj):
+        if is_tracked(ref) and not isinstance(ref, NOT_TRAVERSED_FOR_CYCLES):
+          keys.append(id(ref))
+          if id(ref) not in objs:
+            stack.append(ref)
+    return objs, referents
+
+
+NOT_TRAVERSED_FOR_CYCLES = (type, types.ModuleType, types.FunctionType,
+                            types.CodeType, types.FrameType)
+
+
+# Hands out one canonical instance of each distinct string and encoded
+# leaf (an encoding with no REFs in it, like ['REF', 3],
+# ['HEAP_PRIMITIVE', 'int', 0] or ['FUNCTION', 'f(x)', None]), so that
+# equal ones all over a trace share memory instead of each being its own
+# allocation. Canonical leaves are shared, so they must never be
+# modified.
+#
+# Everything canonical stays alive as long as the HashConser does, so
+# use one per trace (and not for traces whose entries get dropped as
+# they go, or it'd hold on to what they dropped).
+#
+# Leaves are compared with ==, which can't tell 1, 1.0 and True apart,
+# but encodings never put those in the same place without a type name
+# that tells them apart (see HEAP_PRIMITIVE).
+class HashConser:
+  def __init__(self):
+    # Key: a string
+    # Value: the canonical string equal to it
+    self.strings = {}
+    # Key: a leaf as a tuple (with the lists inside it as tuples too)
+    # Value: the canonical leaf
+    self.leaves = {}
+    # Key: small ID
+    # Value: the canonical ['REF', small ID]
+    self.refs = {}
+
+    # how many strings and leaves were asked for, and how many bytes
+    # were saved by handing back canonical ones instead (not counting
+    # REFs, which never even get allocated when they're already there)
+    self.string_lookups = 0
+    self.leaf_lookups = 0
+    self.ref_lookups = 0
+    self.bytes_saved = 0
+
+  def string(self, s):
+    self.string_lookups += 1
+    canonical = self.strings.setdefault(s, s)
+    if canonical is not s:
+      self.bytes_saved += sys.getsizeof(s)
+    return canonical
+
+  def leaf(self, encoded):
+    self.leaf_lookups += 1
+    try:
+      key = tuple(encoded)
+      canonical = self.leaves.get(key)
+    except TypeError:
+      # (there's a list in it)
+      try:
+        key = tuple([tuple(e) if type(e) is list else e for e in encoded])
+        canonical = self.leaves.get(key)
+      except TypeError:
+        return encoded # too deep to bother
+
+    if canonical is None:
+      for (i, e) in enumerate(encoded):
+        if type(e) is str:
+          encoded[i] = self.string(e)
+        elif type(e) is list:
+          encoded[i] = self.leaf(e)
+      canonical = self.leaves[key] = encoded
+    elif canonical is not encoded:
+      self.bytes_saved += sys.getsizeof(encoded)
+    return canonical
+
+  def ref(self, small_id):
+    self.ref_lookups += 1
+    canonical = self.refs.get(small_id)
+    if canonical is None:
+      canonical = self.refs[small_id] = ['REF', small_id]
+    return canonical
+
+  # Returns dedupe statistics: for strings, leaves and REFs, how many
+  # were asked for, how many distinct ones there were and how many got
+  # deduped, and the bytes saved (by strings and leaves)
+  def stats(self):
+    ret = {}
+    for (kind, lookups, canonical) in (('strings', self.string_lookups, self.strings),
+                                       ('leaves', self.leaf_lookups, self.leaves),
+                                       ('refs', self.ref_lookups, self.refs)):
+      ret[kind] = dict(lookups=lookups, distinct=len(canonical),
+                       deduped=lookups - len(canonical))
+    ret['bytes_saved'] = self.bytes_saved
+    return ret
+
+
 # Note that this might BLOAT MEMORY CONSUMPTION since we're holding on
 # to every reference ever created by the program without ever releasing
-# anything!
+# anything! (well, except for the small IDs of objects that died, which
+# SmallIDRegistry takes care of)
+#
+# Budgets, to bound how long encoding a step can take (None means no
+# limit). Contents that don't fit get replaced by a 'TRUNCATED' marker:
+#   max_elements: most elements (or pairs, or attributes) of any one
+#                 object to encode
+#   max_depth:    objects this many references away from the value passed
+#                 to encode (which is 1 deep) don't get their contents
+#                 encoded. depth counts from where an object is first
+#                 reached during a step.
+#   max_objects:  once the heap has this many objects, objects don't get
+#                 their contents encoded. objects already being encoded
+#                 (one per level of nesting that encode is in) still get
+#                 the rest of their elements in, though, as objects
+#                 without contents. so max_objects alone doesn't bound
+#                 the heap. with max_elements and max_depth also set,
+#                 the encode call that fills the heap up leaves at most
+#                   max_objects + 2 * max_elements * (max_depth - 1)
+#                 objects in it (2 per element, since dict keys and
+#                 values can both be objects), and each later call in
+#                 the same step adds at most one more.
+#
+# If hash_conser is a HashConser, REFs, strings and leaf encodings all
+# come from it.
 class ObjectEncoder:
-  def __init__(self, render_heap_primitives):
+  def __init__(self, render_heap_primitives, max_elements=None, max_depth=None,
+               max_objects=None, hash_conser=None):
     # Key: canonicalized small ID
     # Value: encoded (compound) heap object
     self.encoded_heap_objects = {}
 
+    # the heap that get_heap returned last
+    self.prev_heap = {}
+
     self.render_heap_primitives = render_heap_primitives
 
-    self.id_to_small_IDs = {}
-    self.cur_small_ID = 1
+    self.max_elements = max_elements
+    self.max_depth = max_depth
+    self.max_objects = max_objects
+    self.has_budgets = (max_elements is not None or max_depth is not None or
+                        max_objects is not None)
+
+    self.small_IDs = SmallIDRegistry()
+
+    self.hash_conser = hash_conser
+
+    # Encodings of objects that can't change (see remember_immutable), so
+    # that they don't get re-encoded at every step.
+    # Key:   small ID
+    # Value: (object, its encoding, list of (small ID, encoding) of the
+    #        heap objects under it, what its encoding depends on, how many
+    #        levels of objects have their contents in it -- 0 for ones
+    #        without contents, like functions -- for checking budgets)
+    #
+    # Entries hold on to their objects, so a cached small ID's id() can't
+    # be reused by some new object. To avoid keeping garbage alive forever,
+    # an entry only survives a reset_heap if it was used since the
+    # previous one.
+    self.immutable_encodings = {}
+    self.prev_immutable_encodings = {}
+
+    # Things derived from code objects and types, which stay the same for
+    # the whole trace, so they only get worked out once:
+    # Key:   (function type, code object, function name)
+    # Value: pretty name, like 'f(x, *args)'
+    self.function_pretty_names = {}
+    # Key:   type that isn't a class, function, etc.
+    # Value: the name that typeRE or classRE pulls out of it
+    self.type_names = {}
+    # Key:   class (weakly, so classes the program is done with can go)
+    # Value: (its __bases__, names of its superclasses but object)
+    self.superclass_names = weakref.WeakKeyDictionary()
+    # Key:   type of an object with a __dict__ (weakly, like above)
+    # Value: dict with
+    #          Key:   tuple of the keys of its __dict__, in order
+    #          Value: sorted list of the ones to display
+    #        which gets cleared once it has SORTED_USER_ATTRS_PER_TYPE
+    #        entries (objects that keep gaining attributes would
+    #        otherwise add one at every step)
+    self.sorted_user_attrs = weakref.WeakKeyDictionary()
 
     # wow, creating unique identifiers for lambdas is quite annoying,
     # especially if we want to properly differentiate:
@@ -187,8 +535,28 @@ class ObjectEncoder:
     self.line_to_lambda_code = defaultdict(list)
 
 
+  # Returns the heap encoded since the last reset_heap, sharing as much as
+  # possible with the heap it returned last time: objects whose encodings
+  # didn't change are the very same lists as last time, and if nothing
+  # changed, it's the very same dict. So heaps returned by get_heap must
+  # never be modified (make a copy), and should only be asked for once
+  # encoding for the step is done.
   def get_heap(self):
-    return self.encoded_heap_objects
+    heap = self.encoded_heap_objects
+    prev_heap = self.prev_heap
+
+    unchanged = (len(heap) == len(prev_heap))
+    for (k, v) in heap.items():
+      prev_v = prev_heap.get(k)
+      if prev_v is not v:
+        if prev_v == v:
+          heap[k] = prev_v
+        else:
+          unchanged = False
+
+    if not unchanged:
+      self.prev_heap = heap
+    return self.prev_heap
 
 
   def reset_heap(self):
@@ -197,141 +565,473 @@ class ObjectEncoder:
     # called earlier to return a reference to a previous heap state
     self.encoded_heap_objects = {}
 
+    self.prev_immutable_encodings = self.immutable_encodings
+    self.immutable_encodings = {}
+
+  # the key that a function's cached encoding depends on
+  def function_key(self, func):
+    return (func.__code__, func.__name__) if is_python3 else (func.func_code, func.__name__)
+
+  # Caches new_obj as the encoding of dat, if dat can't change. That's
+  # modules, functions (whose names only depend on their code, while their
+  # parent frames get looked up again each time), and tuples of those and
+  # of primitives, as long as everything else they hold has been cached
+  # too and there's at most MAX_CACHED_DESCENDANTS of it. (Primitives that
+  # are heap objects are quicker to encode again than to get from here.)
+  def remember_immutable(self, my_small_id, dat, new_obj):
+    typ = type(dat)
+    key = None
+    descendants = []
+    levels = 0
+
+    if typ is tuple:
+      levels = 1
+      for e in new_obj[1:]:
+        if type(e) is list and e[0] == 'REF':
+          encoded = self.encoded_heap_objects[e[1]]
+          if encoded[0] == 'HEAP_PRIMITIVE':
+            # (the tuple holds on to it, so its small ID stays its own)
+            descendants.append((e[1], encoded))
+          else:
+            entry = self.immutable_encodings.get(e[1]) or \
+                    self.prev_immutable_encodings.get(e[1])
+            # functions need their parents looked up, so they don't count
+            if not entry or entry[3] is not None:
+              return
+            descendants.append((e[1], entry[1]))
+            descendants.extend(entry[2])
+            levels = max(levels, 1 + entry[4])
+          if len(descendants) > MAX_CACHED_DESCENDANTS:
+            return
+    elif typ is types.FunctionType:
+      key = self.function_key(dat)
+      new_obj = new_obj[:-1] # without the parent frame ID
+
+    self.immutable_encodings[my_small_id] = (dat, new_obj, descendants, key, levels)
+
+  # If dat's encoding is cached, and encoding dat depth deep wouldn't run
+  # into the budgets, puts it (and everything under it) into the heap and
+  # returns True
+  def encode_from_cache(self, my_small_id, dat, get_parent, depth):
+    entry = self.immutable_encodings.get(my_small_id)
+    if not entry:
+      entry = self.prev_immutable_encodings.get(my_small_id)
+      if not entry:
+        return False
+      self.immutable_encodings[my_small_id] = entry
+
+    cached_dat, new_obj, descendants, key, levels = entry
+    if cached_dat is not dat or \
+       (key is not None and key != self.function_key(dat)):
+      del self.immutable_encodings[my_small_id]
+      return False
+
+    # (the cached encoding has everything in it, which encoding dat again
+    # would only give if none of it got truncated)
+    if levels and self.has_budgets:
+      if self.max_depth is not None and depth + levels > self.max_depth:
+        return False
+      if self.max_objects is not None and \
+         len(self.encoded_heap_objects) + 1 + len(descendants) >= self.max_objects:
+        return False
+
+    if key is not None:
+      new_obj = new_obj + [get_parent(dat) if get_parent else None]
+      if self.hash_conser:
+        new_obj = self.hash_conser.leaf(new_obj)
+    self.encoded_heap_objects[my_small_id] = new_obj
+    for (small_id, encoded) in descendants:
+      self.encoded_heap_objects[small_id] = encoded
+    return True
+
   def set_function_parent_frame_ID(self, ref_obj, enclosing_frame_id):
     assert ref_obj[0] == 'REF'
     func_obj = self.encoded_heap_objects[ref_obj[1]]
     assert func_obj[0] == 'FUNCTION'
-    func_obj[-1] = enclosing_frame_id
+    # (replace it rather than change it, since earlier heaps might share it)
+    func_obj = func_obj[:-1] + [enclosing_frame_id]
+    if self.hash_conser:
+      func_obj = self.hash_conser.leaf(func_obj)
+    self.encoded_heap_objects[ref_obj[1]] = func_obj
 
 
   # return either a primitive object or an object reference;
   # and as a side effect, update encoded_heap_objects
+  #
+  # Objects get encoded depth-first (so small IDs come out in the same
+  # order as they would recursively), but with an explicit stack instead
+  # of recursion, so that deeply nested data can't hit the recursion limit.
   def encode(self, dat, get_parent):
     """Encode a data value DAT using the GET_PARENT function for parent ids."""
     # primitive type
-    if not self.render_heap_primitives and type(dat) in PRIMITIVE_TYPES:
-      return encode_primitive(dat)
+    if not self.render_heap_primitives and type(dat) in PRIMITIVE_TYPE_SET:
+      return self.encode_primitive(dat)
+
     # compound type - return an object reference and update encoded_heap_objects
+    result = []
+
+    # each element is (list to append the encodings to, iterator over the
+    # objects to encode, get_parent for them, what to pass to
+    # remember_immutable once they're all done, if anything, and a
+    # 'TRUNCATED' marker to append after them, if any). if the list is
+    # None, the iterator gives (list to append to, object) pairs instead.
+    stack = [(result, iter((dat,)), get_parent, None, None)]
+
+    render_heap_primitives = self.render_heap_primitives
+    heap = self.encoded_heap_objects
+    small_IDs = self.small_IDs
+    id_to_small_IDs = small_IDs.small_ids
+    immutable_encodings = self.immutable_encodings
+    prev_immutable_encodings = self.prev_immutable_encodings
+    handlers = self.handlers
+    encode_from_cache = self.encode_from_cache
+    remember_immutable = self.remember_immutable
+    has_budgets = self.has_budgets
+    hash_conser = self.hash_conser
+    if render_heap_primitives:
+      encode_child_primitive = self.heap_primitive_ref
+    elif hash_conser:
+      encode_child_primitive = self.encode_primitive
     else:
-      my_id = id(dat)
+      encode_child_primitive = encode_primitive
+    primitive_types = PRIMITIVE_TYPE_SET # (quicker to look in than a tuple)
+    second = itemgetter(1) # (of the pairs that some handlers return)
+    encode_heap_primitive = self.encode_heap_primitive
+    limit = None
 
-      try:
-        my_small_id = self.id_to_small_IDs[my_id]
-      except KeyError:
-        my_small_id = self.cur_small_ID
-        self.id_to_small_IDs[my_id] = self.cur_small_ID
-        self.cur_small_ID += 1
+    while stack:
+      (encoded_list, children, get_parent, to_remember, marker) = stack[-1]
+      target = encoded_list
+      for dat in children:
+        if encoded_list is None:
+          (target, dat) = dat
+
+        typ = type(dat)
+        if not render_heap_primitives and typ in primitive_types:
+          if hash_conser and (typ is str or typ is float):
+            target.append(self.encode_primitive(dat))
+          else:
+            target.append(encode_primitive(dat))
+          continue
 
-      del my_id # to prevent bugs later in this function
+        try:
+          my_small_id = id_to_small_IDs[id(dat)]
+        except KeyError:
+          my_small_id = small_IDs.add(dat)
 
-      ret = ['REF', my_small_id]
+        if hash_conser:
+          target.append(hash_conser.ref(my_small_id))
+        else:
+          target.append(['REF', my_small_id])
 
-      # punt early if you've already encoded this object
-      if my_small_id in self.encoded_heap_objects:
-        return ret
+        # punt early if you've already encoded this object
+        if my_small_id in heap:
+          continue
 
+        if typ in primitive_types:
+          # a heap primitive, which has no contents, so it's quicker to
+          # encode it again than to get it from the cache
+          heap[my_small_id] = encode_heap_primitive(dat)
+          continue
 
-      # major side-effect!
-      new_obj = []
-      self.encoded_heap_objects[my_small_id] = new_obj
+        if (my_small_id in immutable_encodings or my_small_id in prev_immutable_encodings) and \
+           encode_from_cache(my_small_id, dat, get_parent, len(stack)):
+          continue
 
-      typ = type(dat)
+        # major side-effect!
+        new_obj = []
+        heap[my_small_id] = new_obj
 
-      if typ == list:
-        new_obj.append('LIST')
-        for e in dat:
-          new_obj.append(self.encode(e, get_parent))
-      elif typ == tuple:
-        new_obj.append('TUPLE')
-        for e in dat:
-          new_obj.append(self.encode(e, get_parent))
-      elif typ == set:
-        new_obj.append('SET')
-        for e in dat:
-          new_obj.append(self.encode(e, get_parent))
-      elif typ == dict:
-        new_obj.append('DICT')
-        for (k, v) in dat.items():
-          # don't display some built-in locals ...
-          if k not in ('__module__', '__return__', '__locals__'):
-            new_obj.append([self.encode(k, get_parent), self.encode(v, get_parent)])
-      elif typ in (types.FunctionType, types.MethodType):
-        if is_python3:
-          argspec = inspect.getfullargspec(dat)
-        else:
-          argspec = inspect.getargspec(dat)
+        if has_budgets:
+          (limit, reason) = self.get_limit(len(stack))
+
+        handler = handlers.get(typ)
+        if handler is None:
+          handler = self.get_fallback_handler(dat)
+        (child_list, grandchildren, child_get_parent, remember, num_left_out) = \
+            handler(self, dat, new_obj, get_parent, limit)
+
+        child_marker = None
+        if num_left_out:
+          # don't cache it, since next time it might fit
+          remember = False
+          child_marker = ['TRUNCATED', num_left_out, reason]
+          if hash_conser:
+            child_marker = hash_conser.leaf(child_marker)
+          if child_list is None:
+            # the pairs are already in there
+            new_obj.append(child_marker)
+            child_marker = None
+
+        if grandchildren and not num_left_out and primitive_types.issuperset(
+            map(type, grandchildren if child_list is not None
+                      else map(second, grandchildren))):
+          # they're all primitives (the most common case), so encode them
+          # right here rather than pushing a frame for them
+          if child_list is None:
+            for (pair, child) in grandchildren:
+              pair.append(encode_child_primitive(child))
+          elif render_heap_primitives:
+            # (heap_primitive_ref, without a call for each)
+            for child in grandchildren:
+              try:
+                child_id = id_to_small_IDs[id(child)]
+              except KeyError:
+                child_id = small_IDs.add(child)
+              if child_id not in heap:
+                heap[child_id] = encode_heap_primitive(child)
+              if hash_conser:
+                child_list.append(hash_conser.ref(child_id))
+              else:
+                child_list.append(['REF', child_id])
+          elif not hash_conser and \
+               VERBATIM_TYPE_SET.issuperset(map(type, grandchildren)):
+            child_list.extend(grandchildren)
+          else:
+            child_list.extend(map(encode_child_primitive, grandchildren))
 
-        printed_args = [e for e in argspec.args]
-        if argspec.varargs:
-          printed_args.append('*' + argspec.varargs)
+          if remember:
+            remember_immutable(my_small_id, dat, new_obj)
+          continue
 
-        if is_python3:
-          if argspec.varkw:
-            printed_args.append('**' + argspec.varkw)
-          if argspec.kwonlyargs:
-            printed_args.extend(argspec.kwonlyargs)
+        if grandchildren:
+          # encode those first, then pick up where we left off
+          stack.append((child_list, iter(grandchildren), child_get_parent,
+                        (my_small_id, dat, new_obj) if remember else None,
+                        child_marker))
+          break
+        elif child_marker:
+          new_obj.append(child_marker)
         else:
-          if argspec.keywords:
-            printed_args.append('**' + argspec.keywords)
+          if hash_conser:
+            # nothing more goes in, so it's a leaf
+            new_obj = heap[my_small_id] = hash_conser.leaf(new_obj)
+          if remember:
+            remember_immutable(my_small_id, dat, new_obj)
+      else:
+        stack.pop()
+        if marker:
+          encoded_list.append(marker)
+        elif to_remember:
+          remember_immutable(*to_remember)
 
-        func_name = get_name(dat)
+    return result[0]
 
-        pretty_name = func_name
 
-        # sometimes might fail for, say, <genexpr>, so just ignore
-        # failures for now ...
-        try:
-          pretty_name += '(' + ', '.join(printed_args) + ')'
-        except TypeError:
-          pass
-
-        # put a line number suffix on lambdas to more uniquely identify
-        # them, since they don't have names
-        if func_name == '<lambda>':
-            cod = (dat.__code__ if is_python3 else dat.func_code) # ugh!
-            lst = self.line_to_lambda_code[cod.co_firstlineno]
-            if cod not in lst:
-                lst.append(cod)
-            pretty_name += create_lambda_line_number(cod,
-                                                     self.line_to_lambda_code)
-
-        encoded_val = ['FUNCTION', pretty_name, None]
-        if get_parent:
-          enclosing_frame_id = get_parent(dat)
-          encoded_val[2] = enclosing_frame_id
-        new_obj.extend(encoded_val)
-      elif typ is types.BuiltinFunctionType:
-        pretty_name = get_name(dat) + '(...)'
-        new_obj.extend(['FUNCTION', pretty_name, None])
-      elif is_class(dat) or is_instance(dat):
-        self.encode_class_or_instance(dat, new_obj)
-      elif typ is types.ModuleType:
-        new_obj.extend(['module', dat.__name__])
-      elif typ in PRIMITIVE_TYPES:
-        assert self.render_heap_primitives
-        new_obj.extend(['HEAP_PRIMITIVE', type(dat).__name__, encode_primitive(dat)])
+  # Returns (most elements that an object depth deep can have encoded,
+  # or None for all of them, and the reason for the limit)
+  def get_limit(self, depth):
+    if self.max_depth is not None and depth >= self.max_depth:
+      return (0, 'depth')
+    elif self.max_objects is not None and \
+         len(self.encoded_heap_objects) >= self.max_objects:
+      return (0, 'objects')
+    else:
+      return (self.max_elements, 'elements')
+
+  # Handlers for encode. Each one starts encoding dat into new_obj,
+  # leaving out all but the first limit elements (if limit isn't None),
+  # and returns (list to append the encodings of the objects inside dat
+  # to, those objects in order, get_parent for them, whether new_obj can
+  # be cached by remember_immutable once they're done, and how many
+  # elements it left out). if the list is None, the objects come as (list
+  # to append to, object) pairs instead.
+
+  def encode_list(self, dat, new_obj, get_parent, limit):
+    new_obj.append('LIST')
+    if limit is not None and len(dat) > limit:
+      return (new_obj, itertools.islice(dat, limit), get_parent, False, len(dat) - limit)
+    return (new_obj, dat, get_parent, False, 0)
+
+  def encode_tuple(self, dat, new_obj, get_parent, limit):
+    new_obj.append('TUPLE')
+    if limit is not None and len(dat) > limit:
+      return (new_obj, itertools.islice(dat, limit), get_parent, False, len(dat) - limit)
+    return (new_obj, dat, get_parent, True, 0)
+
+  def encode_set(self, dat, new_obj, get_parent, limit):
+    new_obj.append('SET')
+    if limit is not None and len(dat) > limit:
+      return (new_obj, itertools.islice(dat, limit), get_parent, False, len(dat) - limit)
+    return (new_obj, dat, get_parent, False, 0)
+
+  def encode_dict(self, dat, new_obj, get_parent, limit):
+    new_obj.append('DICT')
+    items = dat.items()
+    # don't display some built-in locals ...
+    if not HIDDEN_DICT_KEYS.isdisjoint(dat):
+      items = [(k, v) for (k, v) in items if k not in HIDDEN_DICT_KEYS]
+
+    num_left_out = 0
+    if limit is not None and len(items) > limit:
+      num_left_out = len(items) - limit
+      items = itertools.islice(items, limit)
+
+    # pairs of primitives get encoded right away, except when hash-consing
+    # primitives that aren't heap objects (a dict left with nothing else
+    # to encode counts as a leaf, and leaf keys can't tell True from 1).
+    # heap primitives only get encoded right away up to the first pair
+    # that isn't primitives, so that small IDs still come out in order.
+    render_heap_primitives = self.render_heap_primitives
+    if render_heap_primitives:
+      (primitive_types, encode) = (PRIMITIVE_TYPE_SET, self.heap_primitive_ref)
+    elif self.hash_conser:
+      (primitive_types, encode) = ((), None)
+    else:
+      (primitive_types, encode) = (PRIMITIVE_TYPE_SET, encode_primitive)
+
+    children = []
+    for (k, v) in items:
+      if type(k) in primitive_types and type(v) in primitive_types and \
+         not (render_heap_primitives and children):
+        new_obj.append([encode(k), encode(v)])
       else:
-        typeStr = str(typ)
-        m = typeRE.match(typeStr)
+        pair = []
+        new_obj.append(pair)
+        children.append((pair, k))
+        children.append((pair, v))
+    return (None, children, get_parent, False, num_left_out)
 
-        if not m:
-          m = classRE.match(typeStr)
+  def encode_function(self, dat, new_obj, get_parent, limit):
+    pretty_name = self.get_function_pretty_name(dat)
 
-        assert m, typ
+    encoded_val = ['FUNCTION', pretty_name, None]
+    if get_parent:
+      enclosing_frame_id = get_parent(dat)
+      encoded_val[2] = enclosing_frame_id
+    new_obj.extend(encoded_val)
+    return (None, None, None, type(dat) is types.FunctionType, 0)
 
-        if is_python3:
-          encoded_dat = str(dat)
-        else:
-          # ugh, for bytearray() in Python 2, str() returns
-          # non-JSON-serializable characters, so need to decode:
-          encoded_dat = str(dat).decode('utf-8', 'replace')
-        new_obj.extend([m.group(1), encoded_dat])
+  def encode_builtin_function(self, dat, new_obj, get_parent, limit):
+    pretty_name = get_name(dat) + '(...)'
+    new_obj.extend(['FUNCTION', pretty_name, None])
+    return (None, None, None, False, 0)
+
+  # Returns a REF to primitive dat as a heap object, encoding it into the
+  # heap if it isn't in there yet
+  def heap_primitive_ref(self, dat):
+    try:
+      my_small_id = self.small_IDs.small_ids[id(dat)]
+    except KeyError:
+      my_small_id = self.small_IDs.add(dat)
+    if my_small_id not in self.encoded_heap_objects:
+      self.encoded_heap_objects[my_small_id] = self.encode_heap_primitive(dat)
+    if self.hash_conser:
+      return self.hash_conser.ref(my_small_id)
+    return ['REF', my_small_id]
 
-      return ret
+  # the encoding of a primitive that's a heap object
+  def encode_heap_primitive(self, dat):
+    assert self.render_heap_primitives
+    typ = type(dat)
+    encoded = ['HEAP_PRIMITIVE', typ.__name__,
+               dat if typ in VERBATIM_TYPE_SET else encode_primitive(dat)]
+    if self.hash_conser:
+      encoded = self.hash_conser.leaf(encoded)
+    return encoded
 
+  # encode_primitive, with the strings and lists it returns hash-consed
+  def encode_primitive(self, dat):
+    encoded = encode_primitive(dat)
+    if self.hash_conser:
+      if type(encoded) is str:
+        return self.hash_conser.string(encoded)
+      elif type(encoded) is list:
+        return self.hash_conser.leaf(encoded)
+    return encoded
 
-  def encode_class_or_instance(self, dat, new_obj):
+  def encode_module(self, dat, new_obj, get_parent, limit):
+    new_obj.extend(['module', dat.__name__])
+    return (None, None, None, True, 0)
+
+  def encode_other(self, dat, new_obj, get_parent, limit):
+    typ = type(dat)
+    type_name = self.type_names.get(typ)
+    if type_name is None:
+      typeStr = str(typ)
+      m = typeRE.match(typeStr)
+
+      if not m:
+        m = classRE.match(typeStr)
+
+      assert m, typ
+      type_name = self.type_names[typ] = m.group(1)
+
+    if is_python3:
+      encoded_dat = str(dat)
+    else:
+      # ugh, for bytearray() in Python 2, str() returns
+      # non-JSON-serializable characters, so need to decode:
+      encoded_dat = str(dat).decode('utf-8', 'replace')
+    new_obj.extend([type_name, encoded_dat])
+    return (None, None, None, False, 0)
+
+  # for types that aren't in self.handlers (which only has exact types)
+  def get_fallback_handler(self, dat):
+    if is_class(dat) or is_instance(dat):
+      return ObjectEncoder.encode_class_or_instance
+    elif type(dat) is types.ModuleType:
+      return ObjectEncoder.encode_module
+    else:
+      return ObjectEncoder.encode_other
+
+
+  def get_function_pretty_name(self, dat):
+    # (methods can wrap things that aren't functions, which have no code)
+    cod = getattr(dat, '__code__' if is_python3 else 'func_code', None) # ugh!
+    func_name = get_name(dat)
+    key = (type(dat), cod, func_name)
+    pretty_name = self.function_pretty_names.get(key)
+    if pretty_name is not None:
+      return pretty_name
+
+    if is_python3:
+      argspec = inspect.getfullargspec(dat)
+    else:
+      argspec = inspect.getargspec(dat)
+
+    printed_args = [e for e in argspec.args]
+    if argspec.varargs:
+      printed_args.append('*' + argspec.varargs)
+
+    if is_python3:
+      if argspec.varkw:
+        printed_args.append('**' + argspec.varkw)
+      if argspec.kwonlyargs:
+        printed_args.extend(argspec.kwonlyargs)
+    else:
+      if argspec.keywords:
+        printed_args.append('**' + argspec.keywords)
+
+    pretty_name = func_name
+
+    # sometimes might fail for, say, <genexpr>, so just ignore
+    # failures for now ...
+    try:
+      pretty_name += '(' + ', '.join(printed_args) + ')'
+    except TypeError:
+      pass
+
+    # put a line number suffix on lambdas to more uniquely identify
+    # them, since they don't have names
+    if func_name == '<lambda>':
+        lst = self.line_to_lambda_code[cod.co_firstlineno]
+        if cod not in lst:
+            lst.append(cod)
+        pretty_name += create_lambda_line_number(cod,
+                                                 self.line_to_lambda_code)
+
+    if cod is not None:
+      self.function_pretty_names[key] = pretty_name
+    return pretty_name
+
+
+  def encode_class_or_instance(self, dat, new_obj, get_parent, limit):
     """Encode dat as a class or instance."""
+    # (in Python 3, modules are instances and end up here, but there's
+    # nothing inside them that gets encoded, so they can be cached)
+    is_module = type(dat) is types.ModuleType
+
     if is_instance(dat):
       if hasattr(dat, '__class__'):
         # common case ...
@@ -353,25 +1053,78 @@ class ObjectEncoder:
           pprint_str = '<incomplete object>'
 
         new_obj.extend(['INSTANCE_PPRINT', class_name, pprint_str])
-        return # bail early
+        return (None, None, None, is_module, 0) # bail early
       else:
         new_obj.extend(['INSTANCE', class_name])
         # don't traverse inside modules, or else risk EXPLODING the visualization
         if class_name == 'module':
-          return
+          return (None, None, None, is_module, 0)
     else:
-      superclass_names = [e.__name__ for e in dat.__bases__ if e is not object]
-      new_obj.extend(['CLASS', get_name(dat), superclass_names])
+      # (__bases__ can be reassigned, so check that it's still the same)
+      cached = self.superclass_names.get(dat)
+      if cached and cached[0] is dat.__bases__:
+        superclass_names = cached[1]
+      else:
+        superclass_names = [e.__name__ for e in dat.__bases__ if e is not object]
+        self.superclass_names[dat] = (dat.__bases__, superclass_names)
+      new_obj.extend(['CLASS', get_name(dat), list(superclass_names)])
 
     # traverse inside of its __dict__ to grab attributes
     # (filter out useless-seeming ones, based on anecdotal observation):
     hidden = ('__doc__', '__module__', '__return__', '__dict__',
         '__locals__', '__weakref__', '__qualname__')
     if hasattr(dat, '__dict__'):
-      user_attrs = sorted([e for e in dat.__dict__ if e not in hidden])
+      # objects of the same class usually have the same attributes
+      attrs = tuple(dat.__dict__)
+      typ = type(dat)
+      sorted_attrs = self.sorted_user_attrs.get(typ)
+      if sorted_attrs is None:
+        sorted_attrs = self.sorted_user_attrs[typ] = {}
+      user_attrs = sorted_attrs.get(attrs)
+      if user_attrs is None:
+        user_attrs = sorted([e for e in attrs if e not in hidden])
+        if len(sorted_attrs) >= SORTED_USER_ATTRS_PER_TYPE:
+          sorted_attrs.clear()
+        sorted_attrs[attrs] = user_attrs
     else:
       user_attrs = []
 
+    num_left_out = 0
+    if limit is not None and len(user_attrs) > limit:
+      num_left_out = len(user_attrs) - limit
+      user_attrs = user_attrs[:limit]
+
+    # (like in encode_dict)
+    render_heap_primitives = self.render_heap_primitives
+    if render_heap_primitives:
+      (primitive_types, encode) = (PRIMITIVE_TYPE_SET, self.heap_primitive_ref)
+    elif self.hash_conser:
+      (primitive_types, encode) = ((), None)
+    else:
+      (primitive_types, encode) = (PRIMITIVE_TYPE_SET, encode_primitive)
+
+    children = []
     for attr in user_attrs:
-      new_obj.append([self.encode(attr, None), self.encode(dat.__dict__[attr], None)])
+      value = dat.__dict__[attr]
+      if type(value) in primitive_types and \
+         not (render_heap_primitives and children):
+        new_obj.append([encode(attr), encode(value)])
+      else:
+        pair = []
+        new_obj.append(pair)
+        children.append((pair, attr))
+        children.append((pair, value))
+    return (None, children, None, is_module, num_left_out)
+
 
+# Key:   exact type
+# Value: ObjectEncoder method that encodes values of that type
+ObjectEncoder.handlers = {
+  list: ObjectEncoder.encode_list,
+  tuple: ObjectEncoder.encode_tuple,
+  set: ObjectEncoder.encode_set,
+  dict: ObjectEncoder.encode_dict,
+  types.FunctionType: ObjectEncoder.encode_function,
+  types.MethodType: ObjectEncoder.encode_function,
+  types.BuiltinFunctionType: ObjectEncoder.encode_builtin_function,
+}
@@ -29,16 +29,20 @@
 # of all in-scope data structures after each executed instruction.
 
 
-import imp
 import sys
 import bdb # the KEY import here!
 import re
 import traceback
 import types
+import dis
+from collections import OrderedDict
 
 # TODO: use the 'six' package to smooth out Py2 and Py3 differences
 is_python3 = (sys.version_info[0] == 3)
 
+# sys.monitoring (PEP 669) is new in Python 3.12
+has_sys_monitoring = hasattr(sys, 'monitoring')
+
 # NB: don't use cStringIO since it doesn't support unicode!!!
 if is_python3:
   import io as StringIO
@@ -389,6 +393,117 @@ def filter_var_dict(d):
   return ret
 
 
+# for record_accesses: what each opcode does to variables. 'use' and 'def'
+# read and write the named variable, looked up the way the opcode does
+# ('fast', 'name', 'global' or 'deref'). 'deref' opcodes read or write
+# some attribute or item of an object on the value stack, which we can't
+# see, so only how many of them ran gets recorded.
+ACCESS_OPS = {
+  'LOAD_FAST': ('use', 'fast'),
+  'LOAD_FAST_CHECK': ('use', 'fast'),
+  'LOAD_FAST_LOAD_FAST': ('use', 'fast'),
+  'STORE_FAST': ('def', 'fast'),
+  'STORE_FAST_STORE_FAST': ('def', 'fast'),
+  'DELETE_FAST': ('def', 'fast'),
+  'LOAD_NAME': ('use', 'name'),
+  'LOAD_FROM_DICT_OR_GLOBALS': ('use', 'name'),
+  'STORE_NAME': ('def', 'name'),
+  'DELETE_NAME': ('def', 'name'),
+  'LOAD_GLOBAL': ('use', 'global'),
+  'STORE_GLOBAL': ('def', 'global'),
+  'DELETE_GLOBAL': ('def', 'global'),
+  'LOAD_DEREF': ('use', 'deref'),
+  'LOAD_CLASSDEREF': ('use', 'deref'),
+  'LOAD_FROM_DICT_OR_DEREF': ('use', 'deref'),
+  'STORE_DEREF': ('def', 'deref'),
+  'DELETE_DEREF': ('def', 'deref'),
+  'LOAD_ATTR': ('deref', None),
+  'LOAD_METHOD': ('deref', None),
+  'LOAD_SUPER_ATTR': ('deref', None),
+  'STORE_ATTR': ('deref', None),
+  'DELETE_ATTR': ('deref', None),
+  'BINARY_SUBSCR': ('deref', None),
+  'STORE_SUBSCR': ('deref', None),
+  'DELETE_SUBSCR': ('deref', None),
+  'BINARY_SLICE': ('deref', None),
+  'STORE_SLICE': ('deref', None),
+}
+
+# returns a dict mapping the offset of each instruction in code that
+# touches variables to a list of (action, scope kind, name)
+#
+# comprehensions that Python 3.12+ inlines (PEP 709) keep their variables
+# in fast locals of the enclosing code, even at the module level: a run of
+# LOAD_FAST_AND_CLEAR saves (and clears) them first, and a SWAP followed by
+# STORE_FASTs puts the saved values back afterward (once where the loop
+# ends and once more in the exception handler). the variables in between
+# are the comprehension's own, so none of that gets recorded -- otherwise
+# a module-level comprehension would look like it defined globals, and one
+# in a function like it redefined the function's locals.
+def get_code_accesses(code):
+  ret = {}
+  instrs = list(dis.get_instructions(code))
+
+  # sets of variables of the inlined comprehensions we're inside of, from
+  # the outermost one in, and all variables of inlined comprehensions
+  comprehension_vars = []
+  all_comprehension_vars = set()
+  hidden = set()
+
+  i = 0
+  while i < len(instrs):
+    instr = instrs[i]
+
+    if instr.opname == 'LOAD_FAST_AND_CLEAR':
+      names = set()
+      while i < len(instrs) and instrs[i].opname == 'LOAD_FAST_AND_CLEAR':
+        names.add(instrs[i].argval)
+        i += 1
+      comprehension_vars.append(names)
+      all_comprehension_vars.update(names)
+      hidden = set().union(*comprehension_vars)
+      continue
+
+    if instr.opname == 'SWAP':
+      restored = set()
+      j = i + 1
+      while j < len(instrs) and instrs[j].opname in ('STORE_FAST', 'STORE_FAST_STORE_FAST'):
+        names = instrs[j].argval
+        if type(names) is not tuple:
+          names = (names,)
+        if not all_comprehension_vars.issuperset(names):
+          break
+        restored.update(names)
+        j += 1
+      if restored:
+        if comprehension_vars and comprehension_vars[-1] == restored:
+          comprehension_vars.pop()
+          hidden = set().union(*comprehension_vars)
+        i = j
+        continue
+
+    if instr.opname == 'STORE_FAST_LOAD_FAST':
+      store_name, load_name = instr.argval
+      accesses = [('def', 'fast', store_name), ('use', 'fast', load_name)]
+    elif instr.opname in ACCESS_OPS:
+      (action, scope_kind) = ACCESS_OPS[instr.opname]
+      if action == 'deref':
+        accesses = [(action, None, None)]
+      elif type(instr.argval) is tuple: # e.g., LOAD_FAST_LOAD_FAST
+        accesses = [(action, scope_kind, name) for name in instr.argval]
+      else:
+        accesses = [(action, scope_kind, instr.argval)]
+    else:
+      accesses = None
+
+    if accesses and hidden:
+      accesses = [e for e in accesses if not (e[1] == 'fast' and e[2] in hidden)]
+    if accesses:
+      ret[instr.offset] = accesses
+    i += 1
+  return ret
+
+
 # yield all function objects locally-reachable from frame,
 # making sure to traverse inside all compound objects ...
 def visit_all_locally_reachable_function_objs(frame):
@@ -441,6 +556,54 @@ def visit_function_obj(v, ids_seen_set):
     yield None
 
 
+# Every frame PGLogger has seen, indexed both ways, plus the zombie frames,
+# so that looking any of them up doesn't mean scanning a list
+class FrameRegistry():
+    def __init__(self):
+        # Key: frame object
+        # Value: monotonically increasing small ID, based on call order
+        self.ids = {}
+        self.next_id = 1
+
+        # Key: small ID
+        # Value: the frame that currently has it
+        self.frames_by_id = {}
+
+        # List of frames to KEEP AROUND after the function exits, in the
+        # order they were added. (A generator's frame gets added each
+        # time it's resumed in cumulative_mode, and rendered that many
+        # times, so this can have repeats.)
+        self.zombies = []
+        self.zombie_set = set()
+
+    def __contains__(self, frame):
+      return frame in self.ids
+
+    # Gives frame the next small ID (again, if it's a generator's frame
+    # being resumed) and returns it
+    def add(self, frame):
+      frame_id = self.next_id
+      self.next_id += 1
+      self.ids[frame] = frame_id
+      self.frames_by_id[frame_id] = frame
+      return frame_id
+
+    def get_id(self, frame):
+      return self.ids.get(frame)
+
+    def add_zombie(self, frame):
+      self.zombies.append(frame)
+      self.zombie_set.add(frame)
+
+    def is_zombie(self, frame):
+      return frame in self.zombie_set
+
+    def lookup_zombie(self, frame_id):
+      frame = self.frames_by_id.get(frame_id)
+      assert frame in self.zombie_set # should never fail
+      return frame
+
+
 class PGLogger(bdb.Bdb):
     # if custom_modules is non-empty, it should be a dict mapping module
     # names to the python source code of each module. when _runscript is
@@ -450,9 +613,61 @@ class PGLogger(bdb.Bdb):
     #
     # if separate_stdout_by_module, then have a separate stdout stream
     # for each module rather than all stdout going to a single stream
+    #
+    # if heap_delta_interval is non-null, then only every
+    # heap_delta_interval-th trace entry carries a full 'heap' snapshot;
+    # the entries in between carry a 'heap_diff' against the previous
+    # entry instead (see reconstruct_heap)
+    #
+    # if incremental_stdout, then each trace entry's 'stdout' holds only
+    # the output written since the previous entry (see get_full_stdout)
+    #
+    # if step_callback is non-null, then each trace entry is handed to it
+    # as soon as it's produced INSTEAD of being accumulated in self.trace
+    # (see exec_script_str_iter)
+    #
+    # max_executed_lines overrides MAX_EXECUTED_LINES for this logger
+    #
+    # if dataflow_only, then record only what dependence analysis needs:
+    # line, event, globals, the heap, and just the innermost user frame in
+    # stack_to_render (with frame_id, unique_hash and encoded_locals). no
+    # zombie frames, closure parents, ordered_* lists, probes or stdout.
+    # that frame is always the one that's running (never a zombie, which
+    # the full trace's last frame can be), its unique_hash never changes,
+    # and its locals include the free variables it reads from enclosing
+    # functions (which the full trace leaves to the parent frames), so
+    # slices of closures and of recursive code can come out bigger.
+    #
+    # ignored_events is a collection of event names that never make it
+    # into the trace (e.g., 'raw_input')
+    #
+    # if record_accesses, then trace opcodes too, and give each trace entry
+    # an 'accesses' list of the variable reads and writes made since the
+    # previous entry, in order:
+    #   ['use', frame_id, scope, name, ref]
+    #   ['def', frame_id, scope, name]
+    #   ['deref', frame_id] (an attribute or item access on some object)
+    # frame_id is the small ID (see FrameRegistry) of the frame doing the access
+    # (None for the global scope), scope is a frame_id or 'global', and ref
+    # is the small ID of the value read, if it has one
+    #
+    # heap_max_elements, heap_max_depth and heap_max_objects are budgets for
+    # encoding each step's heap (see pg_encoder.ObjectEncoder); whatever
+    # doesn't fit gets a 'TRUNCATED' marker instead
+    #
+    # hash_conser is the pg_encoder.HashConser that the trace's REFs,
+    # leaf encodings and strings (stdout, func_name, unique_hash, ...) come
+    # from, so that equal ones share memory. if it's None, each trace gets
+    # its own, except with a step_callback (where keeping canonical values
+    # alive would defeat the point of dropping entries as they go), which
+    # gets none. pass one in to look at its stats() afterwards.
     def __init__(self, cumulative_mode, heap_primitives, show_only_outputs, finalizer_func,
                  disable_security_checks=False, crazy_mode=False,
-                 custom_modules=None, separate_stdout_by_module=False, probe_exprs=None):
+                 custom_modules=None, separate_stdout_by_module=False, probe_exprs=None,
+                 heap_delta_interval=None, incremental_stdout=False, step_callback=None,
+                 max_executed_lines=None, dataflow_only=False, ignored_events=None,
+                 record_accesses=False, heap_max_elements=None, heap_max_depth=None,
+                 heap_max_objects=None, hash_conser=None):
         bdb.Bdb.__init__(self)
         self.mainpyfile = ''
         self._wait_for_mainpyfile = 0
@@ -465,6 +680,15 @@ class PGLogger(bdb.Bdb):
         self.separate_stdout_by_module = separate_stdout_by_module
         self.stdout_by_module = {} # Key: module name, Value: StringIO faux-stdout
 
+        self.incremental_stdout = incremental_stdout
+        # Key: module name (or None for the single stdout stream)
+        # Value: offset up to which that stream's output has already been
+        #        put into the trace; get_user_stdout fills in
+        #        pending_stdout_offsets, which only get committed once the
+        #        entry actually gets appended to the trace
+        self.stdout_offsets = {}
+        self.pending_stdout_offsets = {}
+
         self.modules_to_trace = set(['__main__']) # always trace __main__!
 
         # Key: module name
@@ -499,6 +723,41 @@ class PGLogger(bdb.Bdb):
         # executed line
         self.trace = []
 
+        self.step_callback = step_callback
+
+        # an exception raised by step_callback, which would otherwise get
+        # mixed up with the user program's own exceptions
+        self.step_callback_exception = None
+
+        # bookkeeping that would otherwise require looking at self.trace,
+        # which stays empty when there's a step_callback
+        self.num_trace_entries = 0
+        self.exception_recorded = False
+
+        if max_executed_lines:
+            self.max_executed_lines = max_executed_lines
+        else:
+            self.max_executed_lines = MAX_EXECUTED_LINES
+
+        self.dataflow_only = dataflow_only
+        if ignored_events:
+            self.ignored_events = set(ignored_events)
+        else:
+            self.ignored_events = None
+
+        self.record_accesses = record_accesses
+        # accesses since the last trace entry
+        self.pending_accesses = []
+        # Key: code object
+        # Value: get_code_accesses of it
+        self.code_accesses = {}
+        # Key: code object
+        # Value: the code object it's nested in
+        self.code_parents = {}
+        # Key: code object
+        # Value: small ID of its most recent call's frame
+        self.latest_frame_ids = {}
+
         # if this is true, don't put any more stuff into self.trace
         self.done = False
 
@@ -514,37 +773,57 @@ class PGLogger(bdb.Bdb):
         # Value: parent frame
         self.closures = {}
 
+        # the same closures, indexed for get_parent_frame
+        # Key:   code object
+        # Value: list of (function object, parent frame), in the order
+        #        in which they were added to self.closures
+        self.closures_by_code = {}
+
         # Key:   code object for a lambda
         # Value: parent frame
         self.lambda_closures = {}
 
+        # Key:   frame object
+        # Value: (the closure parent frame that get_parent_frame matched it
+        #        to, how many closures had its code back then)
+        self.parent_frame_cache = {}
+
         # set of function objects that were defined in the global scope
         self.globally_defined_funcs = set()
 
-        # Key: frame object
-        # Value: monotonically increasing small ID, based on call order
-        self.frame_ordered_ids = {}
-        self.cur_frame_id = 1
-
-        # List of frames to KEEP AROUND after the function exits.
-        # If cumulative_mode is True, then keep ALL frames in
-        # zombie_frames; otherwise keep only frames where
-        # nested functions were defined within them.
-        self.zombie_frames = []
+        # small IDs of frames, and which frames to KEEP AROUND after the
+        # function exits. If cumulative_mode is True, then keep ALL frames
+        # as zombies; otherwise keep only frames where nested functions
+        # were defined within them.
+        self.frames = FrameRegistry()
 
-        # set of elements within zombie_frames that are also
+        # set of zombie frames that are also
         # LEXICAL PARENTS of other frames
         self.parent_frames_set = set()
 
         # all globals that ever appeared in the program, in the order in
-        # which they appeared. note that this might be a superset of all
-        # the globals that exist at any particular execution point,
-        # since globals might have been deleted (using, say, 'del')
-        self.all_globals_in_order = []
+        # which they appeared (as the keys; the values are None). note that
+        # this might be a superset of all the globals that exist at any
+        # particular execution point, since globals might have been
+        # deleted (using, say, 'del')
+        self.all_globals_in_order = OrderedDict()
+
+        # Key:   name of a global that was bound to a primitive at the
+        #        previous step (when primitives aren't rendered on the heap)
+        # Value: (that primitive, its encoding)
+        self.prev_primitive_globals = {}
+
+        if hash_conser is None and not step_callback:
+          hash_conser = pg_encoder.HashConser()
+        self.hash_conser = hash_conser
 
         # very important for this single object to persist throughout
         # execution, or else canonical small IDs won't be consistent.
-        self.encoder = pg_encoder.ObjectEncoder(self.render_heap_primitives)
+        self.encoder = pg_encoder.ObjectEncoder(self.render_heap_primitives,
+                                                max_elements=heap_max_elements,
+                                                max_depth=heap_max_depth,
+                                                max_objects=heap_max_objects,
+                                                hash_conser=hash_conser)
 
         self.executed_script = None # Python script to be executed!
 
@@ -557,6 +836,12 @@ class PGLogger(bdb.Bdb):
 
         self.prev_lineno = -1 # keep track of previous line just executed
 
+        self.heap_delta_interval = heap_delta_interval
+        # the heap of the last entry appended to the trace, and how many
+        # heap-carrying entries have been appended since the last full one
+        self.prev_trace_heap = None
+        self.entries_since_heap_keyframe = 0
+
 
     def get_user_stdout(self):
         def encode_stringio(sio):
@@ -573,18 +858,69 @@ class PGLogger(bdb.Bdb):
                                           for e in sio.buflist]
             return sio.getvalue()
 
+        # only grab what was written since the last appended entry
+        # (seeking back and reading to the end leaves the stream
+        # positioned where the user program's next write should go)
+        def encode_stringio_since(sio, key):
+            if not is_python3:
+                sio.buflist = [(e.decode('utf-8', 'replace')
+                                           if type(e) is str
+                                           else e)
+                                          for e in sio.buflist]
+            end = sio.tell()
+            sio.seek(self.stdout_offsets.get(key, 0))
+            chunk = sio.read()
+            self.pending_stdout_offsets[key] = end
+            return chunk
+
         if self.separate_stdout_by_module:
             ret = {}
             for module_name in self.stdout_by_module:
-                ret[module_name] = encode_stringio(self.stdout_by_module[module_name])
+                if self.incremental_stdout:
+                    ret[module_name] = encode_stringio_since(self.stdout_by_module[module_name], module_name)
+                else:
+                    ret[module_name] = encode_stringio(self.stdout_by_module[module_name])
             return ret
         else:
             # common case - single stdout stream
+            if self.incremental_stdout:
+                return encode_stringio_since(self.user_stdout, None)
             return encode_stringio(self.user_stdout)
 
 
+    # replace trace_entry['heap'] with a 'heap_diff' dict against the heap
+    # of the previously-appended entry, unless it's time for a full
+    # snapshot. 'heap_diff' maps each added or changed small ID to its new
+    # encoding and each removed small ID to None.
+    def delta_encode_heap(self, trace_entry):
+      heap = trace_entry['heap']
+      prev_heap = self.prev_trace_heap
+      self.prev_trace_heap = heap
+
+      if prev_heap is None or \
+         self.entries_since_heap_keyframe >= self.heap_delta_interval - 1:
+        self.entries_since_heap_keyframe = 0
+        return # keep the full snapshot
+      self.entries_since_heap_keyframe += 1
+
+      heap_diff = {}
+      # the encoder shares unchanged objects (and whole unchanged heaps)
+      # between entries, so identical ones need no comparing
+      if heap is not prev_heap:
+        for (k, v) in heap.items():
+          prev_v = prev_heap.get(k)
+          if prev_v is not v and prev_v != v:
+            heap_diff[k] = v
+        for k in prev_heap:
+          if k not in heap:
+            heap_diff[k] = None
+
+      del trace_entry['heap']
+      trace_entry['heap_diff'] = heap_diff
+
+
     def get_frame_id(self, cur_frame):
-      return self.frame_ordered_ids[cur_frame]
+      return self.frames.ids[cur_frame]
 
     # Returns the (lexical) parent of a function value.
     def get_parent_of_function(self, val):
@@ -609,40 +945,50 @@ class PGLogger(bdb.Bdb):
     # variables inherited from possible parent frame candidates.
     def get_parent_frame(self, frame):
       #print >> sys.stderr, 'get_parent_frame: frame.f_code', frame.f_code
-      for (func_obj, parent_frame) in self.closures.items():
+      candidates = self.closures_by_code.get(frame.f_code, ())
+
+      # the match from last time still holds as long as no closures with
+      # this code came along since and its locals still match (equal
+      # values can make the wrong parent match at first, until one of
+      # them changes)
+      cached = self.parent_frame_cache.get(frame)
+      if cached:
+        (parent_frame, num_candidates) = cached
+        if num_candidates == len(candidates) and \
+           self.locals_match_parent(frame, parent_frame):
+          return parent_frame
+
+      for (func_obj, parent_frame) in candidates:
         # ok, there's a possible match, but let's compare the
         # local variables in parent_frame to those of frame
-        # to make sure. this is a hack that happens to work because in
-        # Python, each stack frame inherits ('inlines') a copy of the
-        # variables from its (lexical) parent frame.
-        if func_obj.__code__ == frame.f_code:
-          all_matched = True
-          for k in frame.f_locals:
-            # Do not try to match local names
-            if k in frame.f_code.co_varnames:
-              continue
-            if k != '__return__' and k in parent_frame.f_locals:
-              if parent_frame.f_locals[k] != frame.f_locals[k]:
-                all_matched = False
-                break
-
-          if all_matched:
-            return parent_frame
-
-      for (lambda_code_obj, parent_frame) in self.lambda_closures.items():
-        if lambda_code_obj == frame.f_code:
-          # TODO: should we do more verification like above?!?
+        # to make sure.
+        if self.locals_match_parent(frame, parent_frame):
+          self.parent_frame_cache[frame] = (parent_frame, len(candidates))
           return parent_frame
 
-      return None
+      self.parent_frame_cache.pop(frame, None)
+      # TODO: should we do more verification like above?!?
+      # (a guess, so it doesn't get cached)
+      return self.lambda_closures.get(frame.f_code)
+
+    # this is a hack that happens to work because in Python, each stack
+    # frame inherits ('inlines') a copy of the variables from its
+    # (lexical) parent frame.
+    def locals_match_parent(self, frame, parent_frame):
+      my_locals = frame.f_locals
+      parent_locals = parent_frame.f_locals
+      for k in my_locals:
+        # Do not try to match local names
+        if k in frame.f_code.co_varnames:
+          continue
+        if k != '__return__' and k in parent_locals:
+          if parent_locals[k] != my_locals[k]:
+            return False
+      return True
 
 
     def lookup_zombie_frame_by_id(self, frame_id):
-      # TODO: kinda inefficient
-      for e in self.zombie_frames:
-        if self.get_frame_id(e) == frame_id:
-          return e
-      assert False # should never get here
+      return self.frames.lookup_zombie(frame_id)
 
 
     # unused ...
@@ -723,15 +1069,99 @@ class PGLogger(bdb.Bdb):
 
         if exc_type_name == 'RawInputException':
           raw_input_arg = str(exc_value.args[0]) # make sure it's a string so it's JSON serializable!
-          self.trace.append(dict(event='raw_input', prompt=raw_input_arg))
+          self.add_trace_entry(dict(event='raw_input', prompt=raw_input_arg))
           self.done = True
         elif exc_type_name == 'MouseInputException':
           mouse_input_arg = str(exc_value.args[0]) # make sure it's a string so it's JSON serializable!
-          self.trace.append(dict(event='mouse_input', prompt=mouse_input_arg))
+          self.add_trace_entry(dict(event='mouse_input', prompt=mouse_input_arg))
           self.done = True
         else:
           self.interaction(frame, exc_traceback, 'exception')
 
+    # 'opcode' events only come from frames that record_accesses turned
+    # them on for in interaction
+    def trace_dispatch(self, frame, event, arg):
+        if event == 'opcode':
+          if not self.quitting:
+            self.user_opcode(frame, frame.f_lasti)
+          return self.trace_dispatch
+        return bdb.Bdb.trace_dispatch(self, frame, event, arg)
+
+    def user_opcode(self, frame, offset):
+        if self.done or self._wait_for_mainpyfile or self.wait_for_return_stack:
+          return
+
+        code = frame.f_code
+        accesses = self.code_accesses.get(code)
+        if accesses is None:
+          accesses = self.code_accesses[code] = get_code_accesses(code)
+          for e in code.co_consts:
+            if type(e) == types.CodeType:
+              self.code_parents[e] = code
+
+        if offset not in accesses:
+          return
+
+        frame_id = self.frames.get_id(frame)
+        for (action, scope_kind, name) in accesses[offset]:
+          if action == 'deref':
+            self.pending_accesses.append(['deref', frame_id])
+            continue
+
+          if frame_id is None or scope_kind == 'global':
+            scope, namespace = 'global', frame.f_globals
+          elif scope_kind == 'fast':
+            scope, namespace = frame_id, frame.f_locals
+          elif scope_kind == 'name': # class bodies
+            if name in frame.f_locals:
+              scope, namespace = frame_id, frame.f_locals
+            else:
+              scope, namespace = 'global', frame.f_globals
+          else:
+            scope, namespace = self.get_cell_scope(code, frame_id, name), frame.f_locals
+
+          if action == 'def':
+            self.pending_accesses.append(['def', frame_id, scope, name])
+          elif name in namespace: # otherwise it's a builtin or unbound
+            v = namespace[name]
+            if self.render_heap_primitives or type(v) not in pg_encoder.PRIMITIVE_TYPES:
+              ref = self.encoder.small_IDs.get(v)
+            else:
+              ref = None
+            self.pending_accesses.append(['use', frame_id, scope, name, ref])
+
+    # the frame that a closure variable lives in: the most recent call of
+    # the function that defines it
+    def get_cell_scope(self, code, frame_id, name):
+      c = code
+      while c is not None:
+        if name in c.co_cellvars:
+          if c is code:
+            return frame_id
+          return self.latest_frame_ids.get(c, frame_id)
+        c = self.code_parents.get(c)
+      return frame_id
+
+    def add_trace_entry(self, trace_entry):
+        self.num_trace_entries += 1
+        if trace_entry['event'] == 'exception':
+          self.exception_recorded = True
+
+        if self.ignored_events and trace_entry['event'] in self.ignored_events:
+          return
+
+        if self.step_callback:
+          try:
+            self.step_callback(trace_entry)
+          except bdb.BdbQuit:
+            raise
+          except:
+            self.step_callback_exception = sys.exc_info()[1]
+            self.done = True
+            self.force_terminate()
+        else:
+          self.trace.append(trace_entry)
+
     def get_script_line(self, n):
         return self.executed_script_lines[n-1]
 
@@ -811,17 +1241,21 @@ class PGLogger(bdb.Bdb):
         self.encoder.reset_heap() # VERY VERY VERY IMPORTANT,
                                   # or else we won't properly capture heap object mutations in the trace!
 
+        if self.record_accesses:
+          top_frame.f_trace_opcodes = True
+
         if event_type == 'call':
           # Don't be so strict about this assertion because it FAILS
           # when you're calling a generator (not for the first time),
           # since that frame has already previously been on the stack ...
-          #assert top_frame not in self.frame_ordered_ids
+          #assert top_frame not in self.frames
 
-          self.frame_ordered_ids[top_frame] = self.cur_frame_id
-          self.cur_frame_id += 1
+          frame_id = self.frames.add(top_frame)
+          if self.record_accesses:
+            self.latest_frame_ids[top_frame.f_code] = frame_id
 
-          if self.cumulative_mode:
-            self.zombie_frames.append(top_frame)
+          if self.cumulative_mode and not self.dataflow_only:
+            self.frames.add_zombie(top_frame)
 
         # kinda tricky to get the timing right -- basically, as soon as you
         # make a call, set sys.stdout to the stream for the appropriate
@@ -844,6 +1278,11 @@ class PGLogger(bdb.Bdb):
             else:
               sys.stdout = self.stdout_by_module["<other>"]
 
+        if self.dataflow_only:
+          trace_entry = self.create_dataflow_trace_entry(frame, tos, event_type)
+          self.commit_trace_entry(trace_entry, lineno, event_type)
+          return
+
 
         # only render zombie frames that are NO LONGER on the stack
         #
@@ -852,8 +1291,8 @@ class PGLogger(bdb.Bdb):
         # stack. this seems to be relevant only when there's an exception,
         # since the ENTIRE stack is preserved but self.curindex
         # starts decrementing as the exception bubbles up the stack.
-        cur_stack_frames = [e[0] for e in self.stack[:self.curindex+1]]
-        zombie_frames_to_render = [e for e in self.zombie_frames if e not in cur_stack_frames]
+        cur_stack_frames = set(e[0] for e in self.stack[:self.curindex+1])
+        zombie_frames_to_render = [e for e in self.frames.zombies if e not in cur_stack_frames]
 
 
         # each element is a pair of (function name, ENCODED locals dict)
@@ -1024,11 +1463,12 @@ class PGLogger(bdb.Bdb):
               #assert chosen_parent_frame # I hope this always passes :0
 
               # this condition should be False for functions declared in global scope ...
-              if chosen_parent_frame in self.frame_ordered_ids:
+              if chosen_parent_frame in self.frames:
                 self.closures[v] = chosen_parent_frame
+                self.closures_by_code.setdefault(v.__code__, []).append((v, chosen_parent_frame))
                 self.parent_frames_set.add(chosen_parent_frame) # unequivocally add to this set!!!
-                if not chosen_parent_frame in self.zombie_frames:
-                  self.zombie_frames.append(chosen_parent_frame)
+                if not self.frames.is_zombie(chosen_parent_frame):
+                  self.frames.add_zombie(chosen_parent_frame)
           else:
             # look for code objects of lambdas defined within this
             # function, which comes up in cases like line 2 of:
@@ -1042,14 +1482,11 @@ class PGLogger(bdb.Bdb):
                   # TODO: what if it's already in lambda_closures?
                   self.lambda_closures[e] = top_frame
                   self.parent_frames_set.add(top_frame) # copy-paste from above
-                  if not top_frame in self.zombie_frames:
-                    self.zombie_frames.append(top_frame)
-        else:
-          # if there is only a global scope visible ...
-          for (k, v) in get_user_globals(top_frame).items():
-            if (type(v) in (types.FunctionType, types.MethodType) and \
-                v not in self.closures):
-              self.globally_defined_funcs.add(v)
+                  if not self.frames.is_zombie(top_frame):
+                    self.frames.add_zombie(top_frame)
+
+        # (if there is only a global scope visible, encode_user_globals
+        # below takes note of the functions defined in it)
 
 
         # climb up until you find '<module>', which is (hopefully) the global scope
@@ -1075,9 +1512,9 @@ class PGLogger(bdb.Bdb):
           #
           # when baz is executing, the real stack is [foo, bar, baz] but
           # bar is in imported module code, so pg_logger doesn't trace
-          # it, and it doesn't show up in frame_ordered_ids. thus, the
+          # it, and it doesn't show up in self.frames. thus, the
           # stack to render should only be [foo, baz].
-          if cur_frame in self.frame_ordered_ids:
+          if cur_frame in self.frames:
             encoded_stack_locals.append(create_encoded_stack_entry(cur_frame))
             if not top_frame:
                 top_frame = cur_frame
@@ -1088,17 +1525,9 @@ class PGLogger(bdb.Bdb):
 
         # encode in a JSON-friendly format now, in order to prevent ill
         # effects of aliasing later down the line ...
-        encoded_globals = {}
-        cur_globals_dict = get_user_globals(tos[0], at_global_scope=(self.curindex <= 1))
-        for (k, v) in cur_globals_dict.items():
-          if k in self.vars_to_hide:
-            continue
-
-          encoded_val = self.encoder.encode(v, self.get_parent_of_function)
-          encoded_globals[k] = encoded_val
-
-          if k not in self.all_globals_in_order:
-            self.all_globals_in_order.append(k)
+        at_global_scope = (self.curindex <= 1)
+        encoded_globals = self.encode_user_globals(tos[0], self.get_parent_of_function,
+                                                   at_global_scope)
 
         # filter out globals that don't exist at this execution point
         # (because they've been, say, deleted with 'del')
@@ -1170,6 +1599,7 @@ class PGLogger(bdb.Bdb):
         # handle probe_exprs *before* encoding the heap with self.encoder.get_heap
         encoded_probe_vals = {}
         if self.probe_exprs:
+            cur_globals_dict = get_user_globals(tos[0], at_global_scope=at_global_scope)
             if top_frame: # are we in a function call?
                 top_frame_locals = get_user_locals(top_frame)
             else:
@@ -1241,6 +1671,102 @@ class PGLogger(bdb.Bdb):
           trace_entry['exception_msg'] = exc[0].__name__ + ': ' + str(exc[1])
 
 
+        self.commit_trace_entry(trace_entry, lineno, event_type)
+
+
+    # encodes the globals that get_user_globals(frame) would return (but
+    # without making a filtered copy of them first) and adds any new ones
+    # to all_globals_in_order. a global still bound to the very same
+    # primitive as at the previous step keeps its previous encoding, since
+    # encoding it again would give the same thing.
+    #
+    # if at_global_scope, also takes note of the functions defined in the
+    # global scope (see globally_defined_funcs)
+    def encode_user_globals(self, frame, get_parent, at_global_scope):
+      if is_python3:
+        # (a snapshot, since encoding can run user code like __str__)
+        user_globals = list(frame.f_globals.items())
+      else:
+        user_globals = get_user_globals(frame).items()
+
+      prev_primitive_globals = self.prev_primitive_globals
+      primitive_globals = {}
+      cache_primitives = not self.render_heap_primitives
+      all_globals_in_order = self.all_globals_in_order
+
+      encoded_globals = {}
+      for (k, v) in user_globals:
+        if k in IGNORE_VARS or k == '__return__':
+          continue
+
+        if at_global_scope and \
+           type(v) in (types.FunctionType, types.MethodType) and \
+           v not in self.closures:
+          self.globally_defined_funcs.add(v)
+
+        if k in self.vars_to_hide:
+          continue
+
+        if cache_primitives and type(v) in pg_encoder.PRIMITIVE_TYPES:
+          prev = prev_primitive_globals.get(k)
+          if prev and prev[0] is v:
+            encoded_val = prev[1]
+          else:
+            encoded_val = self.encoder.encode(v, get_parent)
+          primitive_globals[k] = (v, encoded_val)
+        else:
+          encoded_val = self.encoder.encode(v, get_parent)
+        encoded_globals[k] = encoded_val
+
+        if k not in all_globals_in_order:
+          all_globals_in_order[k] = None
+
+      self.prev_primitive_globals = primitive_globals
+      return encoded_globals
+
+
+    # encodes only what's needed to follow dataflow (see dataflow_only)
+    def create_dataflow_trace_entry(self, frame, tos, event_type):
+        # live frames below the innermost one don't get rendered, but their
+        # locals still get encoded so that the objects they refer to stay
+        # in the heap across calls (otherwise those objects would look
+        # brand new every time a call returns)
+        stack_to_render = []
+        i = self.curindex
+        while self.stack[i][0].f_code.co_name != '<module>':
+          cur_frame = self.stack[i][0]
+          if cur_frame in self.frames:
+            encoded_locals = {}
+            for (k, v) in get_user_locals(cur_frame).items():
+              if k == '__module__' or k in self.vars_to_hide:
+                continue
+              encoded_locals[k] = self.encoder.encode(v, None)
+
+            if not stack_to_render:
+              frame_id = self.frames.ids[cur_frame]
+              stack_to_render.append(dict(func_name=cur_frame.f_code.co_name,
+                                          frame_id=frame_id,
+                                          unique_hash=cur_frame.f_code.co_name + '_f' + str(frame_id),
+                                          encoded_locals=encoded_locals))
+          i -= 1
+
+        encoded_globals = self.encode_user_globals(tos[0], None, False)
+
+        trace_entry = dict(line=tos[1],
+                           event=event_type,
+                           func_name=tos[0].f_code.co_name,
+                           globals=encoded_globals,
+                           stack_to_render=stack_to_render,
+                           heap=self.encoder.get_heap())
+
+        if event_type == 'exception':
+          exc = frame.f_locals['__exception__']
+          trace_entry['exception_msg'] = exc[0].__name__ + ': ' + str(exc[1])
+
+        return trace_entry
+
+
+    def commit_trace_entry(self, trace_entry, lineno, event_type):
         # append to the trace only the breakpoint line and the next
         # executed line, so that if you set only ONE breakpoint, OPT shows
         # the state before and after that line gets executed.
@@ -1257,7 +1783,16 @@ class PGLogger(bdb.Bdb):
         self.prev_lineno = lineno
 
         if append_to_trace:
-          self.trace.append(trace_entry)
+          if self.hash_conser:
+            self.hash_cons_entry(trace_entry)
+          if self.record_accesses:
+            trace_entry['accesses'] = self.pending_accesses
+            self.pending_accesses = []
+          if self.heap_delta_interval:
+            self.delta_encode_heap(trace_entry)
+          if self.incremental_stdout:
+            self.stdout_offsets.update(self.pending_stdout_offsets)
+          self.add_trace_entry(trace_entry)
 
 
         # sanity check to make sure the state of the world at a 'call' instruction
@@ -1275,13 +1810,38 @@ class PGLogger(bdb.Bdb):
         '''
 
 
-        if len(self.trace) >= MAX_EXECUTED_LINES:
-          self.trace.append(dict(event='instruction_limit_reached', exception_msg='Stopped after running ' + str(MAX_EXECUTED_LINES) + ' steps. Please shorten your code,\nsince Python Tutor is not designed to handle long-running code.'))
+        if self.num_trace_entries >= self.max_executed_lines:
+          self.add_trace_entry(dict(event='instruction_limit_reached', exception_msg='Stopped after running ' + str(self.max_executed_lines) + ' steps. Please shorten your code,\nsince Python Tutor is not designed to handle long-running code.'))
           self.force_terminate()
 
         self.forget()
 
 
+    # swap the strings and leaves in trace_entry (besides the ones the
+    # encoder already took care of) for canonical ones from hash_conser
+    def hash_cons_entry(self, trace_entry):
+        conser = self.hash_conser
+
+        stdout = trace_entry.get('stdout')
+        if type(stdout) is dict:
+          trace_entry['stdout'] = dict((k, conser.string(v)) for (k, v) in stdout.items())
+        elif stdout is not None:
+          trace_entry['stdout'] = conser.string(stdout)
+
+        for k in ('func_name', 'exception_msg'):
+          if k in trace_entry:
+            trace_entry[k] = conser.string(trace_entry[k])
+        if 'ordered_globals' in trace_entry:
+          trace_entry['ordered_globals'] = conser.leaf(trace_entry['ordered_globals'])
+
+        for e in trace_entry['stack_to_render']:
+          e['func_name'] = conser.string(e['func_name'])
+          e['unique_hash'] = conser.string(e['unique_hash'])
+          if 'ordered_varnames' in e:
+            e['ordered_varnames'] = conser.leaf(e['ordered_varnames'])
+            e['parent_frame_id_list'] = conser.leaf(e['parent_frame_id_list'])
+
+
     def _runscript(self, script_str):
         self.executed_script = script_str
         self.executed_script_lines = self.executed_script.splitlines()
@@ -1383,7 +1943,7 @@ class PGLogger(bdb.Bdb):
         if self.custom_modules:
             for mn in self.custom_modules:
                 # http://code.activestate.com/recipes/82234-importing-a-dynamically-generated-module/
-                new_m = imp.new_module(mn)
+                new_m = types.ModuleType(mn) # imp.new_module is gone in Python 3.12
                 exec(self.custom_modules[mn], new_m.__dict__) # exec in custom globals
                 user_globals.update(new_m.__dict__)
 
@@ -1451,6 +2011,15 @@ class PGLogger(bdb.Bdb):
             del sys.modules['os.path']
             del sys.modules['sys']
 
+          if self.record_accesses:
+            # CPython 3.12 only sends 'opcode' events to the frames that
+            # interaction turns them on for if some frame already had them
+            # on when sys.settrace got called (which bdb's run does), so
+            # turn them on here for a moment
+            cur_frame = sys._getframe()
+            cur_frame.f_trace_opcodes = True
+            cur_frame.f_trace_opcodes = False
+
           self.run(script_str, user_globals, user_globals)
         # sys.exit ...
         except SystemExit:
@@ -1475,15 +2044,11 @@ class PGLogger(bdb.Bdb):
           # This looks kinda weird since the exact exception message doesn't
           # need to match up, but in practice, there should be at most only
           # ONE exception per trace.
-          already_caught = False
-          for e in self.trace:
-            if e['event'] == 'exception':
-              already_caught = True
-              break
+          already_caught = self.exception_recorded
 
           if not already_caught:
             if not self.done:
-              self.trace.append(trace_entry)
+              self.add_trace_entry(trace_entry)
 
           raise bdb.BdbQuit # need to forceably STOP execution
 
@@ -1497,7 +2062,7 @@ class PGLogger(bdb.Bdb):
       sys.stdout = self.GAE_STDOUT # very important!
       sys.stderr = self.ORIGINAL_STDERR
 
-      assert len(self.trace) <= (MAX_EXECUTED_LINES + 1)
+      assert len(self.trace) <= (self.max_executed_lines + 1)
 
       # don't do this anymore ...
       '''
@@ -1532,6 +2097,175 @@ class PGLogger(bdb.Bdb):
         return self.finalizer_func(self.executed_script, self.trace)
 
 
+# A PGLogger that gets its events from sys.monitoring instead of
+# sys.settrace, so that frames outside of the user's code cost nothing:
+# events are only turned on for code objects compiled from the user's
+# script (and custom_modules). It makes the same calls to user_call,
+# user_line, user_return and user_exception that bdb would, following how
+# CPython 3.12 emulates sys.settrace on top of sys.monitoring, so the trace
+# comes out the same.
+#
+# Falls back to plain bdb tracing if sys.monitoring isn't available or
+# another tool already holds its debugger slot.
+class MonitoringPGLogger(PGLogger):
+    def run(self, cmd, globals=None, locals=None):
+        if not has_sys_monitoring:
+          return PGLogger.run(self, cmd, globals, locals)
+
+        monitoring = sys.monitoring
+        tool_id = monitoring.DEBUGGER_ID
+        try:
+          monitoring.use_tool_id(tool_id, 'pg_logger')
+        except ValueError:
+          return PGLogger.run(self, cmd, globals, locals)
+
+        if globals is None:
+          import __main__
+          globals = __main__.__dict__
+        if locals is None:
+          locals = globals
+
+        self.reset()
+        if isinstance(cmd, str):
+          cmd = compile(cmd, "<string>", "exec")
+
+        # same as the 'run' frame from bdb.py that's at the bottom of
+        # self.stack when tracing with bdb
+        self.botframe = sys._getframe()
+
+        self.user_codes = set()
+        self.add_user_code(cmd)
+        # functions from custom_modules have already been defined by now
+        for v in list(globals.values()):
+          if type(v) is types.FunctionType:
+            if v.__globals__.get('__name__') in self.modules_to_trace:
+              self.add_user_code(v.__code__)
+          elif isinstance(v, type) and v.__module__ in self.modules_to_trace:
+            for attr in v.__dict__.values():
+              if type(attr) is types.FunctionType:
+                self.add_user_code(attr.__code__)
+
+        # line offsets for each code object, only needed for jumps
+        self.code_lines = {}
+
+        E = monitoring.events
+        local_events = E.PY_START | E.PY_RESUME | E.PY_RETURN | E.PY_YIELD | E.LINE | E.JUMP
+        if self.record_accesses:
+          local_events |= E.INSTRUCTION
+        # these can't be turned on per code object, so the callbacks
+        # filter them by self.user_codes instead
+        global_events = E.PY_THROW | E.PY_UNWIND | E.RAISE
+
+        callbacks = {E.PY_START: self.monitor_call,
+                     E.PY_RESUME: self.monitor_call,
+                     E.PY_THROW: self.monitor_throw,
+                     E.LINE: self.monitor_line,
+                     E.JUMP: self.monitor_jump,
+                     E.PY_RETURN: self.monitor_return,
+                     E.PY_YIELD: self.monitor_return,
+                     E.PY_UNWIND: self.monitor_unwind,
+                     E.RAISE: self.monitor_raise,
+                     E.INSTRUCTION: self.monitor_instruction}
+        for (event, callback) in callbacks.items():
+          monitoring.register_callback(tool_id, event, callback)
+
+        try:
+          for code in self.user_codes:
+            monitoring.set_local_events(tool_id, code, local_events)
+          monitoring.set_events(tool_id, global_events)
+          exec(cmd, globals, locals)
+        except bdb.BdbQuit:
+          pass
+        finally:
+          self.quitting = True
+          monitoring.set_events(tool_id, 0)
+          for code in self.user_codes:
+            monitoring.set_local_events(tool_id, code, 0)
+          for event in callbacks:
+            monitoring.register_callback(tool_id, event, None)
+          monitoring.free_tool_id(tool_id)
+
+    # registers code and every code object nested inside of it (functions,
+    # lambdas, comprehensions and class bodies)
+    def add_user_code(self, code):
+      codes = [code]
+      while codes:
+        c = codes.pop()
+        if c in self.user_codes:
+          continue
+        # interaction never traces inside of these anyhow
+        if c.co_name in ('__new__', '__repr__'):
+          continue
+        self.user_codes.add(c)
+        for e in c.co_consts:
+          if type(e) == types.CodeType:
+            codes.append(e)
+
+    def line_at(self, code, offset):
+      if code not in self.code_lines:
+        self.code_lines[code] = list(code.co_lines())
+      for (start, end, line) in self.code_lines[code]:
+        if start <= offset < end:
+          return line
+
+    # runs a bdb-style callback, and stops delivering events once tracing
+    # is over, the same way that sys.settrace gets turned off when a trace
+    # function raises
+    def dispatch(self, func, *args):
+      if self.quitting:
+        return
+      try:
+        func(*args)
+      except:
+        self.quitting = True
+        raise
+
+    # each callback's caller is the user frame that the event is for
+
+    def monitor_call(self, code, offset):
+      frame = sys._getframe(1)
+      self.dispatch(self.user_call, frame, None)
+
+    def monitor_throw(self, code, offset, exc):
+      if code in self.user_codes:
+        frame = sys._getframe(1)
+        self.dispatch(self.user_call, frame, None)
+
+    def monitor_line(self, code, line):
+      frame = sys._getframe(1)
+      self.dispatch(self.user_line, frame)
+
+    # LINE events don't fire for jumping back to the start of the same
+    # line (e.g., a one-line loop), but sys.settrace does report those
+    def monitor_jump(self, code, offset, destination):
+      if destination > offset:
+        return sys.monitoring.DISABLE
+      line = self.line_at(code, destination)
+      if line != self.line_at(code, offset):
+        return sys.monitoring.DISABLE
+      frame = sys._getframe(1)
+      self.dispatch(self.user_line, frame)
+
+    def monitor_instruction(self, code, offset):
+      frame = sys._getframe(1)
+      self.dispatch(self.user_opcode, frame, offset)
+
+    def monitor_return(self, code, offset, retval):
+      frame = sys._getframe(1)
+      self.dispatch(self.user_return, frame, retval)
+
+    def monitor_unwind(self, code, offset, exc):
+      if code in self.user_codes:
+        frame = sys._getframe(1)
+        self.dispatch(self.user_return, frame, None)
+
+    def monitor_raise(self, code, offset, exc):
+      if code in self.user_codes:
+        frame = sys._getframe(1)
+        self.dispatch(self.user_exception, frame,
+                      (type(exc), exc, exc.__traceback__))
+
+
 import json
 
 # the MAIN meaty function!!!
@@ -1545,8 +2279,18 @@ def exec_script_str(script_str, raw_input_lst_json, options_json, finalizer_func
 
   py_crazy_mode = ('py_crazy_mode' in options and options['py_crazy_mode'])
 
-  logger = PGLogger(options['cumulative_mode'], options['heap_primitives'], options['show_only_outputs'], finalizer_func,
-                    crazy_mode=py_crazy_mode)
+  if options.get('monitoring'):
+    logger_class = MonitoringPGLogger
+  else:
+    logger_class = PGLogger
+
+  logger = logger_class(options['cumulative_mode'], options['heap_primitives'], options['show_only_outputs'], finalizer_func,
+                    crazy_mode=py_crazy_mode,
+                    heap_delta_interval=options.get('heap_delta_interval'),
+                    incremental_stdout=options.get('incremental_stdout', False),
+                    heap_max_elements=options.get('heap_max_elements'),
+                    heap_max_depth=options.get('heap_max_depth'),
+                    heap_max_objects=options.get('heap_max_objects'))
 
   # TODO: refactor these NOT to be globals
   global input_string_queue
@@ -1572,9 +2316,38 @@ def exec_script_str(script_str, raw_input_lst_json, options_json, finalizer_func
 #
 # [optional] probe_exprs is a list of strings representing
 # expressions whose values to probe at each step (advanced)
-def exec_script_str_local(script_str, raw_input_lst_json, cumulative_mode, heap_primitives, finalizer_func, probe_exprs=None):
+#
+# [optional] heap_delta_interval enables delta-encoded heaps with a full
+# snapshot every heap_delta_interval entries (see reconstruct_heap)
+#
+# [optional] incremental_stdout makes each entry's 'stdout' hold only
+# newly-written output (see get_full_stdout)
+#
+# [optional] step_callback, max_executed_lines, dataflow_only,
+# ignored_events and record_accesses are passed through to PGLogger
+#
+# [optional] monitoring traces with MonitoringPGLogger, which is faster
+# on Python 3.12+ and the same as PGLogger elsewhere
+#
+# [optional] heap_max_elements, heap_max_depth and heap_max_objects bound
+# how much of the heap gets encoded at each step (see PGLogger)
+#
+# [optional] hash_conser is the pg_encoder.HashConser for the trace (see
+# PGLogger)
+def exec_script_str_local(script_str, raw_input_lst_json, cumulative_mode, heap_primitives, finalizer_func, probe_exprs=None,
+                          heap_delta_interval=None, incremental_stdout=False, step_callback=None,
+                          max_executed_lines=None, dataflow_only=False, ignored_events=None,
+                          monitoring=False, record_accesses=False, heap_max_elements=None,
+                          heap_max_depth=None, heap_max_objects=None, hash_conser=None):
   # TODO: add py_crazy_mode option here too ...
-  logger = PGLogger(cumulative_mode, heap_primitives, False, finalizer_func, disable_security_checks=True, probe_exprs=probe_exprs)
+  logger_class = MonitoringPGLogger if monitoring else PGLogger
+  logger = logger_class(cumulative_mode, heap_primitives, False, finalizer_func, disable_security_checks=True, probe_exprs=probe_exprs,
+                    heap_delta_interval=heap_delta_interval, incremental_stdout=incremental_stdout,
+                    step_callback=step_callback, max_executed_lines=max_executed_lines,
+                    dataflow_only=dataflow_only, ignored_events=ignored_events,
+                    record_accesses=record_accesses, heap_max_elements=heap_max_elements,
+                    heap_max_depth=heap_max_depth, heap_max_objects=heap_max_objects,
+                    hash_conser=hash_conser)
 
   # TODO: refactor these NOT to be globals
   global input_string_queue
@@ -1591,7 +2364,158 @@ def exec_script_str_local(script_str, raw_input_lst_json, cumulative_mode, heap_
   except bdb.BdbQuit:
     pass
   finally:
-    return logger.finalize()
+    ret = logger.finalize()
+    if logger.step_callback_exception:
+      raise logger.step_callback_exception
+    return ret
+
+
+# rebuild the full heap as of trace[step] for a trace produced with
+# heap_delta_interval, by starting from the closest full 'heap' snapshot
+# at or before step and replaying the 'heap_diff' entries after it.
+# entries that carry neither (e.g., 'raw_input') leave the heap as is.
+#
+# works on traces that went through JSON too, since the keys of 'heap'
+# and 'heap_diff' get stringified the same way
+def reconstruct_heap(trace, step):
+  keyframe = step
+  while keyframe >= 0 and 'heap' not in trace[keyframe]:
+    keyframe -= 1
+
+  if keyframe < 0:
+    heap = {}
+  else:
+    heap = dict(trace[keyframe]['heap'])
+
+  for e in trace[keyframe+1:step+1]:
+    if 'heap_diff' in e:
+      for (k, v) in e['heap_diff'].items():
+        if v is None:
+          del heap[k]
+        else:
+          heap[k] = v
+  return heap
+
+
+# return the full stdout as of trace[step] for a trace produced with
+# incremental_stdout, by concatenating the per-entry output chunks. with
+# separate_stdout_by_module, returns a dict mapping module names to
+# their full stdout instead.
+def get_full_stdout(trace, step):
+  chunks = [e['stdout'] for e in trace[:step+1] if 'stdout' in e]
+
+  if chunks and type(chunks[0]) is dict:
+    ret = {}
+    for c in chunks:
+      for (module_name, module_chunk) in c.items():
+        ret[module_name] = ret.get(module_name, '') + module_chunk
+    return ret
+  else:
+    return ''.join(chunks)
+
+
+# like exec_script_str_local, but a generator that yields each trace
+# entry as soon as PGLogger produces it rather than handing the whole
+# trace to a finalizer at the end, so memory stays bounded no matter
+# how long the trace gets. closing the generator (or just dropping it)
+# stops the user script at its next step.
+#
+# the script runs in a worker thread in lockstep with the consumer: the
+# worker blocks after producing each entry until the consumer asks for
+# the next one, and sys.stdout is pointed back at the real stdout in the
+# meantime, so the consumer can print freely between entries. (still not
+# reentrant, though, since the tracer state like input_string_queue is
+# global -- don't start another trace while iterating over this one)
+#
+# extra keyword arguments are passed through to PGLogger
+def exec_script_str_iter(script_str, raw_input_lst_json, cumulative_mode, heap_primitives, probe_exprs=None,
+                         monitoring=False, **kwargs):
+  import threading
+  if is_python3:
+    import queue
+  else:
+    import Queue as queue
+
+  to_consumer = queue.Queue(1)
+  to_worker = queue.Queue(1)
+
+  def step_callback(trace_entry):
+    saved_stdout = sys.stdout
+    sys.stdout = logger.GAE_STDOUT
+    to_consumer.put(('entry', trace_entry))
+    cmd = to_worker.get()
+    sys.stdout = saved_stdout
+    if cmd == 'stop':
+      logger.force_terminate()
+
+  logger_class = MonitoringPGLogger if monitoring else PGLogger
+  logger = logger_class(cumulative_mode, heap_primitives, False, lambda code, trace: None,
+                    disable_security_checks=True, probe_exprs=probe_exprs,
+                    step_callback=step_callback, **kwargs)
+
+  def run():
+    try:
+      try:
+        logger._runscript(script_str)
+      except bdb.BdbQuit:
+        pass
+      finally:
+        logger.finalize()
+    except:
+      to_consumer.put(('error', sys.exc_info()[1]))
+    else:
+      to_consumer.put(('done', None))
+
+  # TODO: refactor these NOT to be globals
+  global input_string_queue
+  input_string_queue = []
+  if raw_input_lst_json:
+    # TODO: if we want to support unicode, remove str() cast
+    input_string_queue = [str(e) for e in json.loads(raw_input_lst_json)]
+
+  global __html__, __css__, __js__
+  __html__, __css__, __js__ = None, None, None
+
+  worker = threading.Thread(target=run)
+  worker.daemon = True
+  worker.start()
+
+  # hold back one entry so that we can apply the same aesthetic rule
+  # as PGLogger.finalize, which drops a trailing 'return' from
+  # <module> right after an 'exception'
+  held = None
+  prev_event = None
+  worker_waiting = False
+  try:
+    while True:
+      (kind, val) = to_consumer.get()
+      worker_waiting = (kind == 'entry')
+      if kind == 'error':
+        raise val
+      elif kind == 'done':
+        break
+
+      if held is not None:
+        prev_event = held['event']
+        yield held
+      held = val
+
+      worker_waiting = False
+      to_worker.put('next')
+
+    if held is not None:
+      if not (prev_event == 'exception' and \
+              held['event'] == 'return' and held['func_name'] == '<module>'):
+        yield held
+  finally:
+    # (a generator that got dropped without being closed only gets
+    # finalized when the interpreter shuts down, by which point the worker
+    # thread has been frozen for good, so waiting on it would hang)
+    if not (is_python3 and sys.is_finalizing()):
+      if worker_waiting:
+        to_worker.put('stop')
+        to_consumer.get() # wait for 'done'
+      worker.join()
 
 
 # deprecated?!?
@@ -1,17 +1,19 @@
-import make_trace
+import make_trace, trace_cache
 import ast, sys, json
 import traceback
+import argparse, io, random, time
+import multiprocessing, multiprocessing.connection
 
 DEBUG = True
 decoder = json.JSONDecoder()
 
-def process_one(outfile, string):
+def process_one(outfile, string, cache=None):
     obj = decoder.decode(string)
     source = obj['user_script']
     ri = json.dumps(obj['raw_input']) if 'raw_input' in obj else '[]'
 
     last_line = len(source.splitlines())
-    slice_lines, slice_p = make_trace.slice(source, ri, debug=True)
+    slice_lines, slice_p = make_trace.slice(source, ri, debug=True, cache=cache)
 
     if slice_lines:
         print('Original code:')
@@ -26,16 +28,177 @@ def process_one(outfile, string):
 
     json.dump(obj, outfile)
 
-with open(sys.argv[1]) as infile:
-    with open(sys.argv[1] + '.sliced', 'wt') as outfile:
+# Runs process_one on a single interaction, capturing what it prints and
+# what it writes to the output file. Returns (printed text, output text).
+#
+# Reseeds random first, like pg_logger does at import time, so each
+# interaction runs the same way no matter which process handles it or what
+# ran there before.
+def run_one(string, cache=None):
+    printed = io.StringIO()
+    output = io.StringIO()
 
-        for i, line in enumerate(infile):
-            print('Interaction ' + str(i))
-            try:
-                process_one(outfile, line)
-            except Exception as e:
-                if DEBUG:
-                    traceback.print_exc(None, sys.stdout)
+    random.seed(0)
+    real_stdout = sys.stdout
+    sys.stdout = printed
+    try:
+        process_one(output, string, cache)
+    except Exception as e:
+        if DEBUG:
+            traceback.print_exc(None, sys.stdout)
+        else:
+            print(e)
+    finally:
+        sys.stdout = real_stdout
+
+    return printed.getvalue(), output.getvalue()
+
+def write_result(outfile, i, result):
+    printed, output = result
+    print('Interaction ' + str(i))
+    sys.stdout.write(printed)
+    print('')
+    outfile.write(output)
+
+def make_cache(cache_dir):
+    return trace_cache.TraceCache(cache_dir) if cache_dir else None
+
+def process_serial(infile, outfile, cache_dir=None):
+    cache = make_cache(cache_dir)
+    for i, line in enumerate(infile):
+        write_result(outfile, i, run_one(line, cache))
+
+# Handles interactions until it gets None. (Closing the pipe isn't enough to
+# stop it, since forked workers inherit each other's pipe ends.)
+def worker_main(conn, cache_dir):
+    cache = make_cache(cache_dir)
+    while True:
+        line = conn.recv()
+        if line is None:
+            break
+        conn.send(run_one(line, cache))
+
+# A worker process handling one interaction at a time
+class Worker():
+    def __init__(self, cache_dir=None):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_main,
+                                               args=(child_conn, cache_dir))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        # Index of the interaction being worked on, and when to give up on it
+        self.index = None
+        self.deadline = None
+
+    def start(self, index, line, timeout):
+        self.conn.send(line)
+        self.index = index
+        self.deadline = time.time() + timeout
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        self.conn.send(None)
+        self.process.join()
+        self.conn.close()
+
+"""
+Slices interactions on a pool of worker processes, writing results in input
+order.
+
+At most max_pending interactions are handed out beyond the oldest one still
+unwritten, which bounds both the work in flight and the results buffered
+for reordering. An interaction whose worker crashes or takes longer than
+timeout seconds gets an error message instead of a result, and only that
+worker is replaced.
+
+Workers share the on-disk tier of the trace cache, if there is one.
+"""
+def process_parallel(infile, outfile, jobs, timeout, max_pending=None,
+                     cache_dir=None):
+    if max_pending is None:
+        max_pending = 4 * jobs
+
+    workers = [Worker(cache_dir) for _ in range(jobs)]
+    lines = enumerate(infile)
+    exhausted = False
+    handed_out = 0
+
+    # Interaction index to (printed text, output text)
+    results = {}
+    next_to_write = 0
+
+    try:
+        while True:
+            for w in workers:
+                if w.index is not None or exhausted:
+                    continue
+                if handed_out - next_to_write >= max_pending:
+                    break
+                try:
+                    i, line = next(lines)
+                except StopIteration:
+                    exhausted = True
+                    break
+                w.start(i, line, timeout)
+                handed_out += 1
+
+            busy = [w for w in workers if w.index is not None]
+            if not busy:
+                break
+
+            wait_time = max(0, min(w.deadline for w in busy) - time.time())
+            ready = multiprocessing.connection.wait([w.conn for w in busy],
+                                                    wait_time)
+
+            for w in busy:
+                if w.conn in ready:
+                    try:
+                        results[w.index] = w.conn.recv()
+                        w.index = None
+                        continue
+                    except EOFError:
+                        failure = 'Worker crashed\n'
+                elif time.time() >= w.deadline:
+                    failure = 'Timed out after ' + str(timeout) + ' seconds\n'
                 else:
-                    print(e)
-            print('')
+                    continue
+
+                results[w.index] = (failure, '')
+                w.kill()
+                workers[workers.index(w)] = Worker(cache_dir)
+
+            while next_to_write in results:
+                write_result(outfile, next_to_write, results.pop(next_to_write))
+                next_to_write += 1
+    finally:
+        for w in workers:
+            if w.index is None:
+                w.stop()
+            else:
+                w.kill()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds before giving up on an interaction '
+                             '(only with --jobs > 1)')
+    parser.add_argument('--cache-dir',
+                        help='directory for caching traces across runs')
+    args = parser.parse_args()
+
+    with open(args.file) as infile:
+        with open(args.file + '.sliced', 'wt') as outfile:
+            if args.jobs > 1:
+                process_parallel(infile, outfile, args.jobs, args.timeout,
+                                 cache_dir=args.cache_dir)
+            else:
+                process_serial(infile, outfile, args.cache_dir)
@@ -0,0 +1,4 @@
+import os, sys
+
+# the modules import each other by their plain names
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,246 @@
+import pytest
+import make_trace, pg_logger, trace_cache, trace_store
+
+# a statement that controls itself mustn't depend on its own step
+def test_slice_all_one_line_while_body():
+    source = 'i = 0\nwhile i < 3: i += 1\nprint(i)\n'
+    slices = make_trace.slice_all(source, '[]')
+    assert slices[3] == frozenset([1, 2, 3])
+
+WITH_SOURCE = '''class C:
+    def __enter__(self):
+        return 5
+    def __exit__(self, *args):
+        return False
+a = 1
+b = 2
+with C() as v:
+    c = v + a
+print(c)
+'''
+
+# with statements are only supported when recording accesses
+def test_with_unsupported_by_default():
+    with pytest.raises(ValueError):
+        make_trace.slice(WITH_SOURCE, '[]', line=10)
+
+def test_with_slice_with_accesses():
+    lines, _ = make_trace.slice(WITH_SOURCE, '[]', line=10, record_accesses=True)
+    assert lines == set([1, 3, 6, 8, 9, 10])
+
+# the variable of a module-level comprehension (which Python 3.12+ inlines)
+# isn't the global of the same name
+def test_inlined_comprehension_variable_is_not_a_global():
+    source = 'x = 5\nd = [1, 2]\ny = [x * 2 for x in d if x]\nprint(x)\n'
+    lines, _ = make_trace.slice(source, '[]', line=4, record_accesses=True)
+    assert lines == set([1, 4])
+
+# the cache key must cover everything trace passes to the tracer
+def test_trace_cache_key_covers_tracer_kwargs(monkeypatch):
+    seen = {}
+    def fake_exec(script_str, raw_input_lst_json, cumulative_mode, heap_primitives,
+                  finalizer_func, **kwargs):
+        seen['kwargs'] = kwargs
+        return []
+    def fake_cache_key(source, ri, options):
+        seen['options'] = options
+        return 'key'
+    monkeypatch.setattr(pg_logger, 'exec_script_str_local', fake_exec)
+    monkeypatch.setattr(trace_cache, 'cache_key', fake_cache_key)
+
+    make_trace.trace('x = 1\n', '[]', cache=trace_cache.TraceCache(),
+                     record_accesses=True)
+    assert set(seen['kwargs']) <= set(seen['options'])
+    assert seen['options']['monitoring'] is True
+    assert seen['options']['record_accesses'] is True
+
+NESTED_CALLS_SOURCE = '''def g(a):
+    return a + 1
+def f(b):
+    return b * 2
+x = f(g(3))
+print(x)
+'''
+
+# arguments are defined by the caller's statement, which passes on the
+# return values of the calls nested in it
+def test_nested_calls_slice_with_accesses():
+    keep, _ = make_trace.slice(NESTED_CALLS_SOURCE, '[]', line=6,
+                               record_accesses=True)
+    assert keep == set([1, 2, 3, 4, 5, 6])
+
+    slices = make_trace.slice_all(NESTED_CALLS_SOURCE, '[]',
+                                  record_accesses=True)
+    assert 0 not in slices
+    assert slices[6] == frozenset([1, 2, 3, 4, 5, 6])
+
+# Slices a trace made some other way than make_trace.trace
+def slice_trace(source, tr, line):
+    line_map, line_to_control = make_trace.make_line_maps(source)
+    builder = make_trace.RelationBuilder(line_map, line_to_control)
+    for exec_point in tr:
+        builder.add(exec_point)
+    keep, _ = make_trace.slice_relations(line_map, builder.graph,
+                                         make_trace.find_exception(tr), line)
+    return keep
+
+def full_trace(source):
+    return pg_logger.exec_script_str_local(source, '[]', True, True,
+                                           lambda c, t: t)
+
+PLAIN_SOURCE = '''def add(a, b):
+    c = a + b
+    return c
+x = 1
+y = 2
+z = add(x, 3)
+w = [z, y]
+w.append(x)
+print(w)
+'''
+
+CLOSURE_SOURCE = '''def outer():
+    x = 1
+    y = 2
+    def inner():
+        return x
+    return inner()
+print(outer())
+'''
+
+RECURSIVE_SOURCE = '''def fact(n):
+    if n <= 1:
+        return 1
+    r = n * fact(n - 1)
+    return r
+print(fact(3))
+'''
+
+# without closures or recursion, the dataflow-only trace slices just like
+# the full one
+def test_dataflow_trace_slices_like_full_trace():
+    full = full_trace(PLAIN_SOURCE)
+    for line in range(1, 10):
+        assert make_trace.slice(PLAIN_SOURCE, '[]', line=line)[0] == \
+               slice_trace(PLAIN_SOURCE, full, line)
+
+# the dataflow-only trace sees free variables in the frame reading them
+# and always looks at the running frame, where the full trace can end up
+# on a zombie one, so those slices only ever get bigger
+def test_dataflow_trace_slices_closures_and_recursion():
+    full = full_trace(CLOSURE_SOURCE)
+    keep, _ = make_trace.slice(CLOSURE_SOURCE, '[]', line=5)
+    assert slice_trace(CLOSURE_SOURCE, full, 5) == set([1, 4, 5])
+    assert keep == set([1, 2, 4, 5, 6])
+
+    full = full_trace(RECURSIVE_SOURCE)
+    keep, _ = make_trace.slice(RECURSIVE_SOURCE, '[]', line=5)
+    assert slice_trace(RECURSIVE_SOURCE, full, 5) == set([1, 5])
+    assert keep == set([1, 4, 5, 6])
+
+# 0 <- 1 <- 3, 2 <- 4, and 3 and 4 <- 5 (step 2 isn't a statement step)
+def small_graph():
+    graph = make_trace.DependenceGraph()
+    for (line, infl_steps) in [(1, []), (2, [0]), (0, []), (3, [1]),
+                               (4, [2]), (5, [3, 4])]:
+        graph.add_step(line, infl_steps)
+    return graph
+
+def test_slice_engine_matches_reachable():
+    graph = small_graph()
+    engine = make_trace.SliceEngine(graph)
+    for step in range(len(graph)):
+        assert set(engine.step_slice(step).steps()) == graph.reachable([step])
+
+def test_slice_set_operations():
+    engine = make_trace.SliceEngine(small_graph())
+    a = engine.step_slice(3)
+    b = engine.step_slice(4)
+
+    assert list((a | b).steps()) == [0, 1, 2, 3, 4]
+    assert list((a & engine.step_slice(5)).steps()) == [0, 1, 3]
+    assert list((engine.step_slice(5) - a).steps()) == [2, 4, 5]
+    assert len(a | b) == 5
+    assert (a | b) == (b | a)
+    assert (a & b) == make_trace.Slice(a.graph)
+    assert 1 in a and 2 not in a
+    assert (a | b).lines() == set([0, 1, 2, 3, 4])
+    assert engine.line_slice(5) == engine.step_slice(5)
+
+# steps come out in increasing order, whatever order they were added in
+def test_slice_iteration_order():
+    graph = small_graph()
+    s = make_trace.Slice(graph, (1 << 5) | (1 << 0) | (1 << 3))
+    assert list(s.steps()) == [0, 3, 5]
+    assert list(make_trace.Slice(graph).steps()) == []
+
+def test_slice_compares_with_other_types():
+    s = make_trace.SliceEngine(small_graph()).step_slice(1)
+    assert s != 3
+    assert not (s == None)
+    assert s != make_trace.Slice(make_trace.DependenceGraph(), s.bits)
+    with pytest.raises(TypeError):
+        s | set([1])
+
+EXCEPTION_SOURCE = '''a = 5
+b = 0
+c = a + 1
+d = a / b
+'''
+
+LOOP_SOURCE = '''total = 0
+for i in range(5):
+    if i % 2:
+        total += i
+print(total)
+'''
+
+# building the dependences while tracing gives the same slices as building
+# them from the finished trace
+@pytest.mark.parametrize('record_accesses', [False, True])
+def test_slice_online_equals_slice(record_accesses):
+    for source in [PLAIN_SOURCE, CLOSURE_SOURCE, RECURSIVE_SOURCE,
+                   NESTED_CALLS_SOURCE, EXCEPTION_SOURCE, LOOP_SOURCE]:
+        for line in range(1, len(source.splitlines()) + 1):
+            assert make_trace.slice_online(source, '[]', line=line,
+                                           record_accesses=record_accesses) == \
+                   make_trace.slice(source, '[]', line=line,
+                                    record_accesses=record_accesses)
+
+# trace files give back every entry as written, in order or by step, with
+# small blocks so that entries span several of them
+@pytest.mark.parametrize('compression', [None, 'zlib', 'lzma'])
+def test_trace_store_round_trip(tmp_path, compression):
+    tr = make_trace.trace(LOOP_SOURCE, '[]')
+    path = str(tmp_path / 'trace')
+    with trace_store.TraceWriter(path, compression, block_bytes=512) as writer:
+        writer.extend(tr)
+
+    with trace_store.TraceReader(path) as reader:
+        assert len(reader) == len(tr)
+        assert list(reader) == tr
+        assert reader[-1] == tr[-1]
+        assert [reader[step] for step in range(len(tr) - 1, -1, -1)] == tr[::-1]
+        with pytest.raises(IndexError):
+            reader[len(tr)]
+
+def test_trace_to_file_slices_like_slice(tmp_path):
+    path = str(tmp_path / 'trace')
+    make_trace.trace_to_file(LOOP_SOURCE, '[]', path, 'zlib')
+    assert make_trace.slice_stored(LOOP_SOURCE, path, line=5) == \
+           make_trace.slice(LOOP_SOURCE, '[]', line=5)
+
+# a file cut off anywhere (say, by a crash while tracing) is refused
+# rather than read as garbage
+def test_trace_store_truncated_file(tmp_path):
+    path = str(tmp_path / 'trace')
+    trace_store.write_trace(path, make_trace.trace(LOOP_SOURCE, '[]'), 'zlib')
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    cut_path = str(tmp_path / 'cut')
+    for size in [0, 5, 20, len(data) // 2, len(data) - 30, len(data) - 1]:
+        with open(cut_path, 'wb') as f:
+            f.write(data[:size])
+        with pytest.raises(ValueError):
+            trace_store.TraceReader(cut_path)
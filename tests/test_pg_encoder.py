@@ -0,0 +1,264 @@
+import gc, random, sys, weakref
+import pg_encoder
+
+class Node():
+    pass
+
+# garbage cycles mustn't stay pinned forever
+def test_sweep_unpins_garbage_cycles():
+    registry = pg_encoder.SmallIDRegistry()
+    freed = []
+    refs = []
+    for i in range(2000):
+        a = []
+        a.append(a)
+        n = Node()
+        n.items = [n]
+        refs.append(weakref.ref(n, freed.append))
+        registry.add(a)
+        registry.add(n.items)
+        registry.add(n)
+    alive = [[1]]
+    alive.append(alive)
+    registry.add(alive)
+
+    registry.sweep()
+    gc.collect()
+
+    # what the loop variables and alive still refer to
+    assert len(registry.pinned) == 3
+    assert registry.get(alive) is not None
+    assert len(freed) == 1999
+
+# cached encodings of immutable objects mustn't get around the budgets
+def test_cached_encodings_respect_budgets():
+    t = ((1, 2), (3, 4))
+
+    enc = pg_encoder.ObjectEncoder(False, max_depth=2)
+    enc.encode(t, None)
+    enc.reset_heap()
+    ref = enc.encode([t], None)
+    heap = enc.get_heap()
+    outer = heap[ref[1]][1][1]
+    assert heap[outer] == ['TUPLE', ['TRUNCATED', 2, 'depth']]
+    assert len(heap) == 2
+
+    enc = pg_encoder.ObjectEncoder(False, max_objects=3)
+    enc.encode(t, None)
+    enc.reset_heap()
+    ref = enc.encode([t], None)
+    heap = enc.get_heap()
+    outer = heap[ref[1]][1][1]
+    for inner in heap[outer][1:]:
+        assert heap[inner[1]] == ['TUPLE', ['TRUNCATED', 2, 'objects']]
+
+# cached tuple encodings list everything under them, so deep nests of
+# tuples only get cached up to MAX_CACHED_DESCENDANTS
+def test_immutable_cache_is_bounded_for_deep_tuples():
+    tup = ()
+    for i in range(5000):
+        tup = (tup,)
+    enc = pg_encoder.ObjectEncoder(False)
+    first = enc.encode(tup, None)
+    first_heap = dict(enc.get_heap())
+    cached = enc.immutable_encodings.values()
+    assert max(len(entry[2]) for entry in cached) <= pg_encoder.MAX_CACHED_DESCENDANTS
+
+    # and encoding it again, partly from the cache, gives the same heap
+    enc.reset_heap()
+    assert enc.encode(tup, None) == first
+    assert enc.get_heap() == first_heap
+
+DEPTH = 10000
+
+# nesting far past the recursion limit encodes fine, down to the bottom
+def test_encode_deep_nesting():
+    assert DEPTH > sys.getrecursionlimit()
+
+    lst = []
+    for i in range(DEPTH):
+        lst = [i, lst]
+    tup = ()
+    for i in range(DEPTH):
+        tup = (tup,)
+    dct = {}
+    for i in range(DEPTH):
+        dct = {'d': dct}
+    node = None
+    for i in range(DEPTH):
+        n = Node()
+        n.next = node
+        node = n
+
+    for render_heap_primitives in (False, True):
+        for (dat, kind, count) in [(lst, 'LIST', DEPTH + 1),
+                                   (tup, 'TUPLE', DEPTH + 1),
+                                   (dct, 'DICT', DEPTH + 1),
+                                   (node, 'INSTANCE', DEPTH)]:
+            enc = pg_encoder.ObjectEncoder(render_heap_primitives)
+            ref = enc.encode(dat, None)
+            heap = enc.get_heap()
+            assert heap[ref[1]][0] == kind
+            assert len([v for v in heap.values() if v[0] == kind]) == count
+
+        # each list refers to the next one in, all the way down
+        enc = pg_encoder.ObjectEncoder(render_heap_primitives)
+        obj = enc.encode(lst, None)
+        heap = enc.get_heap()
+        levels = 0
+        while len(heap[obj[1]]) > 1:
+            obj = heap[obj[1]][-1]
+            levels += 1
+        assert levels == DEPTH
+
+def test_hash_conser_hands_out_canonical_objects():
+    conser = pg_encoder.HashConser()
+    s = conser.string('ab' * 20)
+    assert conser.string(''.join(['ab'] * 20)) is s
+
+    leaf = conser.leaf(['FUNCTION', 'f(x)', None])
+    assert conser.leaf(['FUNCTION', 'f' + '(x)', None]) is leaf
+    assert leaf[1] is conser.string('f(x)')
+    nested = conser.leaf(['TUPLE', ['HEAP_PRIMITIVE', 'int', 1], 'x'])
+    again = conser.leaf(['TUPLE', ['HEAP_PRIMITIVE', 'int', 1], 'x'])
+    assert again is nested
+    assert nested[1] is conser.leaf(['HEAP_PRIMITIVE', 'int', 1])
+    assert conser.leaf(['HEAP_PRIMITIVE', 'int', 2]) is not nested[1]
+
+    assert conser.ref(7) is conser.ref(7)
+    assert conser.ref(7) == ['REF', 7] and conser.ref(8) is not conser.ref(7)
+
+    stats = conser.stats()
+    assert stats['refs'] == dict(lookups=5, distinct=2, deduped=3)
+    assert stats['bytes_saved'] > 0
+
+# a hash-consed trace is equal to one without, and shares its REFs,
+# leaves and strings between entries
+def test_hash_consed_trace_shares_identity():
+    import pg_logger
+    src = '''def f(x):
+    return (x, 'name')
+ys = []
+for i in range(4):
+    ys.append(f(i))
+print(ys)
+'''
+    consed = pg_logger.exec_script_str_local(src, '[]', True, True,
+                                             lambda c, t: t)
+    plain = []
+    pg_logger.exec_script_str_local(src, '[]', True, True, lambda c, t: t,
+                                    step_callback=plain.append)
+    assert consed == plain
+
+    seen = {}
+    def check(obj):
+        if type(obj) is list:
+            if obj and obj[0] == 'REF':
+                assert seen.setdefault(('REF', obj[1]), obj) is obj
+            elif not any(type(e) is list and e[0] == 'REF' for e in obj):
+                # a leaf
+                assert seen.setdefault(repr(obj), obj) is obj
+            for e in obj:
+                check(e)
+        elif type(obj) is str:
+            assert seen.setdefault(obj, obj) is obj
+
+    for entry in consed:
+        check(entry['func_name'])
+        for (name, encoded) in entry['globals'].items():
+            check(encoded)
+        for obj in entry['heap'].values():
+            check(obj)
+        for frame in entry['stack_to_render']:
+            check(frame['unique_hash'])
+            for encoded in frame['encoded_locals'].values():
+                check(encoded)
+    assert ('REF', 1) in seen
+
+# objects holding only primitives get them encoded without a frame of
+# their own, which mustn't change what comes out
+def test_encode_primitive_children():
+    n = Node()
+    n.p = 1
+    n.q = [2]
+    d = {'__return__': 5, 'x': 1.5, 'y': True, '__module__': 'm', 'z': 'a'}
+
+    enc = pg_encoder.ObjectEncoder(False)
+    enc.encode([[1, 'a', None], (2.5, float('inf')), d, {3}, n], None)
+    assert enc.encoded_heap_objects == {
+        1: ['LIST', ['REF', 2], ['REF', 3], ['REF', 4], ['REF', 5], ['REF', 6]],
+        2: ['LIST', 1, 'a', None],
+        3: ['TUPLE', 2.5, ['SPECIAL_FLOAT', 'Infinity']],
+        4: ['DICT', ['x', 1.5], ['y', True], ['z', 'a']],
+        5: ['SET', 3],
+        6: ['INSTANCE', 'Node', ['p', 1], ['q', ['REF', 7]]],
+        7: ['LIST', 2]}
+
+    enc = pg_encoder.ObjectEncoder(False, max_elements=2)
+    enc.encode([d, [1, 'a', None]], None)
+    assert enc.encoded_heap_objects == {
+        1: ['LIST', ['REF', 2], ['REF', 3]],
+        2: ['DICT', ['x', 1.5], ['y', True], ['TRUNCATED', 1, 'elements']],
+        3: ['LIST', 1, 'a', ['TRUNCATED', 1, 'elements']]}
+
+    # heap primitives aren't cached by themselves, but tuples of them are
+    t = (1, 'a', (2,))
+    enc = pg_encoder.ObjectEncoder(True)
+    enc.encode(t, None)
+    heap = enc.get_heap()
+    assert heap == {1: ['TUPLE', ['REF', 2], ['REF', 3], ['REF', 4]],
+                    2: ['HEAP_PRIMITIVE', 'int', 1],
+                    3: ['HEAP_PRIMITIVE', 'str', 'a'],
+                    4: ['TUPLE', ['REF', 5]],
+                    5: ['HEAP_PRIMITIVE', 'int', 2]}
+    assert sorted(enc.immutable_encodings) == [1, 4]
+    enc.reset_heap()
+    enc.encode(t, None)
+    # (straight from the cache, so the very same lists)
+    assert len(enc.encoded_heap_objects) == len(heap)
+    for (small_id, encoded) in heap.items():
+        assert enc.encoded_heap_objects[small_id] is encoded
+
+def random_data(rng, depth):
+    if depth == 0 or rng.random() < 0.2:
+        return rng.choice([1, 'a', 2.5, None, (), rng.randint(0, 10 ** 6)])
+    children = [random_data(rng, depth - 1) for _ in range(rng.randint(0, 6))]
+    kind = rng.choice(['list', 'tuple', 'dict', 'instance'])
+    if kind == 'list':
+        return children
+    elif kind == 'tuple':
+        return tuple(children)
+    elif kind == 'dict':
+        return dict((('k%d' % i) if i % 2 else (i, i), v)
+                    for (i, v) in enumerate(children))
+    obj = Node()
+    for (i, v) in enumerate(children):
+        setattr(obj, 'a%d' % i, v)
+    return obj
+
+# objects still being encoded when the heap fills up get their remaining
+# elements in, so the heap can go past max_objects, but only so far
+def test_max_objects_bound():
+    went_past = 0
+    for seed in range(500):
+        rng = random.Random(seed)
+        dat = random_data(rng, 7)
+        max_elements = rng.randint(1, 5)
+        max_depth = rng.randint(2, 6)
+        max_objects = rng.randint(1, 30)
+        enc = pg_encoder.ObjectEncoder(rng.random() < 0.5,
+                                       max_elements=max_elements,
+                                       max_depth=max_depth,
+                                       max_objects=max_objects)
+        enc.encode(dat, None)
+        size = len(enc.encoded_heap_objects)
+        assert size <= max_objects + 2 * max_elements * (max_depth - 1)
+        if size > max_objects + max_elements:
+            went_past += 1
+
+        # once it's full, later calls add at most one object each
+        if size >= max_objects:
+            enc.encode(random_data(rng, 7), None)
+            enc.encode(random_data(rng, 7), None)
+            assert len(enc.encoded_heap_objects) <= size + 2
+    assert went_past > 0
@@ -0,0 +1,248 @@
+import json, os, subprocess, sys
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs code in a fresh interpreter (with the repo importable) and returns
+# (return code, stdout)
+def run_fresh(code, timeout=30):
+    p = subprocess.run([sys.executable, '-W', 'ignore', '-c', code],
+                       cwd=REPO_DIR, capture_output=True, text=True,
+                       timeout=timeout)
+    return p.returncode, p.stdout
+
+# the very first record_accesses trace in a process has to get opcode
+# events too (CPython 3.12 only delivers them once they've been asked for
+# before tracing starts)
+def test_first_bdb_trace_records_accesses():
+    code = '''
+import pg_logger
+src = 'x = 1\\ny = x + 2\\n'
+trace = pg_logger.exec_script_str_local(src, '[]', True, True,
+                                        lambda c, t: t, monitoring=False,
+                                        record_accesses=True)
+print(sum(len(e.get('accesses', [])) for e in trace))
+'''
+    rc, out = run_fresh(code)
+    assert rc == 0
+    assert int(out) > 0
+
+# a generator from exec_script_str_iter that's dropped without being
+# closed mustn't keep the interpreter from exiting
+def test_abandoned_iter_does_not_hang_at_exit():
+    code = '''
+import pg_logger
+g = pg_logger.exec_script_str_iter('i = 0\\nwhile True:\\n    i += 1\\n', '[]',
+                                   False, False)
+for _ in range(4):
+    next(g)
+print('done')
+'''
+    rc, out = run_fresh(code, timeout=15)
+    assert rc == 0
+    assert out == 'done\n'
+
+# exec_script_str's sandbox empties the gc module, which mustn't break
+# the sweeps that pinning over a thousand objects sets off, in that trace
+# or in later (unsandboxed) ones in the same process
+def test_sandboxed_trace_pins_many_objects():
+    code = '''
+import pg_logger
+src = 'a = list(zip(range(1500)))\\n'
+out = []
+pg_logger.exec_script_str(src, '[]', None, lambda c, t: out.append(t))
+print([e['event'] for e in out[0]])
+trace = pg_logger.exec_script_str_local(src, '[]', False, False, lambda c, t: t)
+print([e['event'] for e in trace])
+'''
+    rc, out = run_fresh(code)
+    assert rc == 0
+    assert out == "['step_line', 'return']\n" * 2
+
+# the dataflow-only trace's one frame is the full trace's running frame,
+# with the free variables it reads from outer functions added in
+def test_dataflow_frame_is_running_frame():
+    import pg_logger
+    src = '''def outer(n):
+    k = n + 1
+    def inner(m):
+        return k + m
+    return inner(2) + inner(3)
+def fact(n):
+    return 1 if n <= 1 else n * fact(n - 1)
+print(outer(1), fact(3))
+'''
+    full = pg_logger.exec_script_str_local(src, '[]', True, True,
+                                           lambda c, t: t)
+    dataflow = pg_logger.exec_script_str_local(src, '[]', True, True,
+                                               lambda c, t: t,
+                                               dataflow_only=True)
+    assert len(full) == len(dataflow)
+    for (f, d) in zip(full, dataflow):
+        assert (f['event'], f['line']) == (d['event'], d['line'])
+        assert f['globals'].keys() == d['globals'].keys()
+        running = [e for e in f['stack_to_render'] if e['is_highlighted']]
+        if not running:
+            assert d['stack_to_render'] == []
+            continue
+        [full_frame] = running
+        [frame] = d['stack_to_render']
+        assert frame['frame_id'] == full_frame['frame_id']
+        extra = set(frame['encoded_locals']) - set(full_frame['encoded_locals'])
+        assert extra <= set(['k'])
+
+SAMPLE_PROGRAMS = [
+    'x = 1\ny = 2\nz = x + 1\nprint(z)\n',
+    'total = 0\nfor i in range(5):\n    total += i\n    print(total)\nprint(total)\n',
+    'x = 0\nwhile x < 5: x += 1\nprint(x)\n',
+    'def f(a, b):\n    c = a + b\n    return c\n\nx = f(1, 2)\ny = f(x, 3)\nprint(y)\n',
+    'def outer(n):\n    def inner(m):\n        return n + m\n    return inner\n\ng = outer(3)\nh = outer(4)\nprint(g(1) + h(2))\n',
+    'def fact(n):\n    if n <= 1:\n        return 1\n    r = n * fact(n - 1)\n    return r\n\nprint(fact(6))\n',
+    'def g(n):\n    for i in range(n):\n        yield i\nt = 0\nfor v in g(3):\n    t += v\nprint(t)\n',
+    'def f():\n    raise ValueError("a")\ntry:\n    f()\nexcept ValueError:\n    y = 1\nprint(y)\nf()\n',
+    'a = 5\nb = 0\nc = a + 1\nd = a / b\n',
+    'class P:\n    def __init__(self, v):\n        self.v = v\n    def __repr__(self):\n        return "P"\n\np = P(3)\nq = p.v\nl = [1, 2, (3, "s")]\nl.append(4)\nd = {"k": l}\nprint(p, q, d)\n',
+    'xs = [i * 2 for i in range(4)]\nf = lambda v: v + 1\nprint(sum(xs), f(2))\n',
+    'x = input("n? ")\ny = int(x) + 1\nprint(y)\n',
+    'i = 0\nwhile True:\n    i += 1\n',
+]
+
+# sys.monitoring (3.12+) has to trace exactly like bdb does
+@pytest.mark.skipif(sys.version_info < (3, 12),
+                    reason='sys.monitoring needs Python 3.12')
+@pytest.mark.parametrize('options', [dict(),
+                                     dict(dataflow_only=True),
+                                     dict(dataflow_only=True, record_accesses=True)])
+def test_monitoring_trace_equals_bdb_trace(options):
+    import pg_logger
+    for src in SAMPLE_PROGRAMS:
+        traces = [pg_logger.exec_script_str_local(src, '["41"]', True, True,
+                                                  lambda c, t: t,
+                                                  monitoring=monitoring,
+                                                  **options)
+                  for monitoring in (False, True)]
+        assert json.dumps(traces[0]) == json.dumps(traces[1]), src
+
+HEAP_PROGRAM = '''class Node:
+    def __init__(self, v):
+        self.v = v
+        self.next = None
+xs = []
+head = None
+for i in range(6):
+    n = Node(i)
+    n.next = head
+    head = n
+    xs.append((i, [i] * 2))
+    if i % 2:
+        xs.pop(0)
+d = {'xs': xs, 'head': head}
+del n
+print(len(xs))
+'''
+
+# delta-encoded heaps rebuild to the same heaps a full trace has, before
+# and after going through JSON
+def test_reconstruct_heap_matches_full_heaps():
+    import pg_logger
+    full = pg_logger.exec_script_str_local(HEAP_PROGRAM, '[]', True, False,
+                                           lambda c, t: t)
+    delta = pg_logger.exec_script_str_local(HEAP_PROGRAM, '[]', True, False,
+                                            lambda c, t: t,
+                                            heap_delta_interval=4)
+    assert len(full) == len(delta)
+    assert any('heap_diff' in e for e in delta)
+    json_full = json.loads(json.dumps(full))
+    json_delta = json.loads(json.dumps(delta))
+    for step in range(len(full)):
+        assert pg_logger.reconstruct_heap(delta, step) == full[step]['heap']
+        assert pg_logger.reconstruct_heap(json_delta, step) == \
+               json_full[step]['heap']
+
+# incremental stdout chunks add back up to the full stdout at every step
+def test_get_full_stdout_matches_full_trace():
+    import pg_logger
+    src = 'x = input("n? ")\nfor i in range(4):\n    print(i, x, end="")\n    if i % 2:\n        print()\nprint("done")\n'
+    full = pg_logger.exec_script_str_local(src, '["hi"]', True, False,
+                                           lambda c, t: t)
+    incremental = pg_logger.exec_script_str_local(src, '["hi"]', True, False,
+                                                  lambda c, t: t,
+                                                  incremental_stdout=True)
+    assert len(full) == len(incremental)
+    assert full[-1]['stdout'].endswith('done\n')
+    for step in range(len(full)):
+        if 'stdout' in full[step]:
+            assert pg_logger.get_full_stdout(incremental, step) == \
+                   full[step]['stdout']
+
+def test_get_full_stdout_by_module():
+    import pg_logger
+    trace = [dict(stdout={'__main__': 'a'}),
+             dict(event='raw_input'),
+             dict(stdout={'__main__': 'b', 'm': 'x'}),
+             dict(stdout={'m': 'y'})]
+    assert pg_logger.get_full_stdout(trace, 1) == {'__main__': 'a'}
+    assert pg_logger.get_full_stdout(trace, 3) == {'__main__': 'ab', 'm': 'xy'}
+
+# globals bound to the same primitive reuse its encoding from the step
+# before, and rebinding them (even to an equal value) encodes them again
+def test_encode_user_globals_rebinding():
+    import pg_logger
+    src = '''x = 1
+x = 1.0
+x = True
+x = 10 ** 20
+x = 10 ** 20 + 0
+del x
+x = 'a'
+def f():
+    global x
+    x = None
+f()
+x = float('nan')
+'''
+    trace = pg_logger.exec_script_str_local(src, '[]', True, False,
+                                            lambda c, t: t)
+    xs = [e['globals'].get('x', '-') for e in trace]
+    assert [repr(x) for x in xs] == [repr(x) for x in [
+        '-', 1, ['SPECIAL_FLOAT', '1.0'], True, 10 ** 20, 10 ** 20, '-',
+        'a', 'a', 'a', 'a', None, None, ['SPECIAL_FLOAT', 'NaN']]]
+
+    # an unchanged global's encoding gets reused (traced without
+    # hash-consing, so that only that reuse can make them the same object)
+    trace = []
+    pg_logger.exec_script_str_local('x = float("inf")\ny = 2\nz = 3\n', '[]',
+                                    True, False, lambda c, t: t,
+                                    step_callback=trace.append)
+    assert trace[1]['globals']['x'] is trace[2]['globals']['x'] is \
+           trace[3]['globals']['x']
+
+# a closure's parent frame is rechecked after other frames running its
+# code have been registered, rather than taken from the first match
+def test_closure_parent_frame_is_rechecked():
+    import pg_logger
+    src = '''def outer(n):
+    def inner(hook):
+        hook()
+        return n
+    def bump():
+        nonlocal n
+        n += 1
+    return inner, bump
+i1, b1 = outer(1)
+i2, b2 = outer(1)
+print(i2(b1))
+'''
+    trace = pg_logger.exec_script_str_local(src, '[]', True, False,
+                                            lambda c, t: t)
+    outer_ids = set()
+    inner_parents = []
+    for e in trace:
+        for frame in e.get('stack_to_render', ()):
+            if frame['func_name'] == 'outer':
+                outer_ids.add(frame['frame_id'])
+            elif frame['func_name'] == 'inner':
+                inner_parents.append(frame['parent_frame_id_list'])
+    assert len(outer_ids) == 2
+    # once bump has changed the first outer's n, only the second matches
+    assert inner_parents[-1] == [max(outer_ids)]
@@ -0,0 +1,139 @@
+import os, hashlib, json, pickle, zlib
+from collections import OrderedDict
+import pg_logger, pg_encoder
+
+# Bump this whenever the shape of cached traces changes in a way that the
+# tracer fingerprint below wouldn't catch
+TRACE_CACHE_VERSION = 1
+
+_tracer_fingerprint = None
+
+# Hash of the tracer's own source, so that editing pg_logger or pg_encoder
+# invalidates everything traced by the old code
+def tracer_fingerprint():
+    global _tracer_fingerprint
+    if _tracer_fingerprint is None:
+        h = hashlib.sha256()
+        for module in (pg_logger, pg_encoder):
+            with open(os.path.splitext(module.__file__)[0] + '.py', 'rb') as f:
+                h.update(f.read())
+        _tracer_fingerprint = h.hexdigest()
+    return _tracer_fingerprint
+
+# Content address for a trace of source with raw_input ri under the given
+# tracer options (a JSON-serializable dict)
+def cache_key(source, ri, options):
+    key_material = json.dumps([TRACE_CACHE_VERSION, tracer_fingerprint(),
+                               source, ri, options], sort_keys=True)
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+"""
+Two-tier cache of traces: an in-process LRU holding at most memory_bytes of
+compressed traces, backed by an optional on-disk store in directory holding
+at most disk_bytes. Both tiers evict least-recently-used entries first.
+
+Traces are stored pickled and compressed, so every get returns a fresh copy
+that the caller is free to modify.
+"""
+class TraceCache():
+    def __init__(self, directory=None, memory_bytes=64 << 20, disk_bytes=1 << 30):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+
+        # Key to compressed trace, least recently used first
+        self.memory = OrderedDict()
+        self.memory_size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        if directory:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.disk_size = sum(os.path.getsize(p) for p in self._disk_entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.trace')
+
+    def _disk_entries(self):
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith('.trace')]
+
+    def _remember(self, key, blob):
+        if key in self.memory:
+            self.memory_size -= len(self.memory.pop(key))
+        if len(blob) > self.memory_bytes:
+            return
+
+        self.memory[key] = blob
+        self.memory_size += len(blob)
+        while self.memory_size > self.memory_bytes:
+            _, old_blob = self.memory.popitem(last=False)
+            self.memory_size -= len(old_blob)
+
+    def _evict_disk(self):
+        entries = []
+        for path in self._disk_entries():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # another process got to it first
+            entries.append((st.st_mtime, st.st_size, path))
+
+        self.disk_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self.disk_size <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.disk_size -= size
+
+    def get(self, key):
+        blob = self.memory.get(key)
+        if blob is not None:
+            self.memory.move_to_end(key)
+        elif self.directory:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    blob = f.read()
+                os.utime(path, None) # mark as recently used
+            except (IOError, OSError):
+                blob = None
+            if blob is not None:
+                self._remember(key, blob)
+
+        if blob is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(zlib.decompress(blob))
+
+    def put(self, key, trace):
+        blob = zlib.compress(pickle.dumps(trace, pickle.HIGHEST_PROTOCOL))
+        self._remember(key, blob)
+
+        if self.directory:
+            # write then rename, so concurrent readers never see half a file
+            path = self._path(key)
+            tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(blob)
+            os.replace(tmp_path, path)
+
+            self.disk_size += len(blob)
+            if self.disk_size > self.disk_bytes:
+                self._evict_disk()
+
+    # Returns the cached trace for key, or computes it with make_trace() and
+    # caches it
+    def get_or_trace(self, key, make_trace):
+        trace = self.get(key)
+        if trace is None:
+            trace = make_trace()
+            self.put(key, trace)
+        return trace
@@ -0,0 +1,168 @@
+"""
+Binary on-disk container for traces, with random access to any step.
+
+Layout (all integers little-endian):
+
+  header:  MAGIC, 1-byte compression code
+  blocks:  u32 stored size, then the block payload, compressed as a whole
+           if there's compression. A payload is a run of step records, each
+           a u32 size followed by the pickled trace entry.
+  index:   per step, u64 file offset of its block and u32 offset of its
+           record within the (decompressed) payload
+  footer:  u64 file offset of the index, u64 number of steps, MAGIC
+
+Reading goes through mmap, so opening a trace only reads its footer, and
+looking at one step only touches that step's block.
+
+Entries are pickled (JSON would turn the heap's int keys into strings), so
+only open trace files you wrote yourself.
+"""
+
+import mmap, os, pickle, struct, zlib, lzma
+
+MAGIC = b'PGTRACE1'
+
+COMPRESSORS = {
+    None: (b'n', None, None),
+    'zlib': (b'z', zlib.compress, zlib.decompress),
+    'lzma': (b'x', lzma.compress, lzma.decompress),
+}
+
+DECOMPRESSORS = dict((code, decompress)
+                     for (code, _, decompress) in COMPRESSORS.values())
+
+HEADER = struct.Struct('<8sc')
+SIZE = struct.Struct('<I')
+INDEX_ENTRY = struct.Struct('<QI')
+FOOTER = struct.Struct('<QQ8s')
+
+class TraceWriter():
+    # compression is None, 'zlib' or 'lzma'. Blocks are cut once they hold
+    # block_bytes of records, so that's roughly how much has to be
+    # decompressed to get at a single step.
+    def __init__(self, path, compression=None, block_bytes=64 << 10):
+        self.code, self.compress, _ = COMPRESSORS[compression]
+        self.block_bytes = block_bytes
+
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, self.code))
+
+        self.block = []
+        self.block_size = 0
+        self.index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Adds one trace entry. Can be used directly as a PGLogger step_callback.
+    def append(self, trace_entry):
+        record = pickle.dumps(trace_entry, pickle.HIGHEST_PROTOCOL)
+        self.index.append((self.file.tell(), self.block_size))
+        self.block.append(SIZE.pack(len(record)))
+        self.block.append(record)
+        self.block_size += SIZE.size + len(record)
+
+        if self.block_size >= self.block_bytes:
+            self.flush_block()
+
+    def extend(self, trace):
+        for trace_entry in trace:
+            self.append(trace_entry)
+
+    def flush_block(self):
+        if not self.block:
+            return
+
+        payload = b''.join(self.block)
+        if self.compress:
+            payload = self.compress(payload)
+        self.file.write(SIZE.pack(len(payload)))
+        self.file.write(payload)
+
+        self.block = []
+        self.block_size = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+
+        self.flush_block()
+        index_offset = self.file.tell()
+        self.file.write(b''.join(INDEX_ENTRY.pack(block_offset, record_offset)
+                                 for (block_offset, record_offset) in self.index))
+        self.file.write(FOOTER.pack(index_offset, len(self.index), MAGIC))
+        self.file.close()
+
+class TraceReader():
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        # (a truncated file is usually too short or has no footer)
+        if os.fstat(self.file.fileno()).st_size < HEADER.size + FOOTER.size:
+            self.file.close()
+            raise ValueError('Not a trace file: ' + path)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, code = HEADER.unpack_from(self.map, 0)
+        index_offset, self.num_steps, end_magic = \
+            FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+        if magic != MAGIC or end_magic != MAGIC or \
+           index_offset + self.num_steps * INDEX_ENTRY.size != len(self.map) - FOOTER.size:
+            self.close()
+            raise ValueError('Not a trace file: ' + path)
+
+        self.decompress = DECOMPRESSORS[code]
+        self.index_offset = index_offset
+
+        # The most recently read block, since steps tend to be read in order
+        self.cached_block_offset = None
+        self.cached_block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.num_steps
+
+    def _block(self, block_offset):
+        if block_offset != self.cached_block_offset:
+            (stored_size,) = SIZE.unpack_from(self.map, block_offset)
+            start = block_offset + SIZE.size
+            payload = self.map[start:start + stored_size]
+            if self.decompress:
+                payload = self.decompress(payload)
+
+            self.cached_block_offset = block_offset
+            self.cached_block = payload
+        return self.cached_block
+
+    def __getitem__(self, step):
+        if step < 0:
+            step += self.num_steps
+        if not 0 <= step < self.num_steps:
+            raise IndexError('trace step out of range')
+
+        block_offset, record_offset = INDEX_ENTRY.unpack_from(
+            self.map, self.index_offset + step * INDEX_ENTRY.size)
+        block = self._block(block_offset)
+
+        (size,) = SIZE.unpack_from(block, record_offset)
+        start = record_offset + SIZE.size
+        return pickle.loads(block[start:start + size])
+
+    def __iter__(self):
+        for step in range(self.num_steps):
+            yield self[step]
+
+def write_trace(path, trace, compression=None):
+    with TraceWriter(path, compression) as writer:
+        writer.extend(trace)